@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the mystock_info pipeline on synthetic payloads (no network access).
+
+Synthetic earnings, valuation and financial payloads of a universe of tickers are
+recorded in a work directory and served by `mi.ReplaySource`. Each stage is timed
+    - cold: empty cache (download from the replay source, normalize and save)
+    - warm: cache files only (memory cache cleared)
+    - hot : cache data kept in memory
+and the peak memory of each stage is measured with tracemalloc in a separate pass
+(tracemalloc slows down the code it traces).
+
+Usage:
+    python bench_mystock_info.py                          # 10, 100 and 5000 tickers
+    python bench_mystock_info.py --sizes 100 --repeat 3 --out bench.json
+    python bench_mystock_info.py --sizes 100 --baseline bench.json  # compare with saved results
+    python bench_mystock_info.py --sizes 1000 --format pickle        # pickle cache files
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+import matplotlib.pyplot as plt
+import pandas as pd
+
+import mystock_info as mi
+
+# labels of si.get_quote_table() and si.get_stats_valuation(). The other labels of
+# mi.valuation_schema are served by si.get_stats().
+quote_labels = ["1y Target Est", "52 Week Range", "Ask", "Avg. Volume", "Beta (5Y Monthly)", "Bid",
+                "Day's Range", "EPS (TTM)", "Earnings Date", "Ex-Dividend Date", "Forward Dividend & Yield",
+                "Market Cap", "Open", "PE Ratio (TTM)", "Previous Close", "Quote Price", "Volume"]
+stats_valuation_labels = ["Market Cap (intraday)", "Enterprise Value", "Trailing P/E", "Forward P/E",
+                          "PEG Ratio (5 yr expected)", "Price/Sales (ttm)", "Price/Book (mrq)",
+                          "Enterprise Value/Revenue", "Enterprise Value/EBITDA"]
+financial_rows = {
+    "cash_flow": ["totalCashFromOperatingActivities", "totalCashflowsFromInvestingActivities",
+                  "totalCashFromFinancingActivities", "netIncome"],
+    "balance_sheet": ["totalAssets", "totalLiabilities"],
+    "income_statement": ["totalRevenue", "operatingIncome", "netIncome", "netIncomeApplicableToCommonShares"],
+}
+
+def universe(n):
+    """Return `n` synthetic ticker names"""
+    return ["S{:05d}".format(i) for i in range(n)]
+
+def _value(rnd, dtype):
+    """Return a synthetic value of Yahoo Finance such as "2.15B", "35.40%" or "Sep 25, 2021" """
+    if dtype == "string":
+        return datetime(2021, rnd.randint(1, 12), rnd.randint(1, 28)).strftime("%b %d, %Y")
+    if rnd.random() < 0.05:
+        return "N/A"
+    return "{:.2f}{}".format(rnd.uniform(-50, 500), rnd.choice(["", "", "%", "M", "B", "T"]))
+
+def synthetic_payloads(ticker, n_quarters=40, invalid_rate=0.01):
+    """Return {payload name: record} of `ticker` in the format of mi.RecordingSource"""
+    rnd = random.Random(ticker)
+    records = {}
+    if rnd.random() < invalid_rate:
+        records[mi.payload_name("company_officers", ticker)] = {"error": "ValueError('invalid ticker')"}
+        return records
+    records[mi.payload_name("company_officers", ticker)] = {"payload": pd.DataFrame({"name": ["CEO"]})}
+
+    eps, rows = rnd.uniform(0.1, 3), []
+    for i in range(n_quarters):
+        eps *= 1 + rnd.gauss(0.01, 0.1)
+        est = round(eps * (1 + rnd.gauss(0, 0.05)), 2)
+        act = round(eps, 2)
+        month = 3 * (i % 4) + 2
+        rows.append({"ticker": ticker, "companyshortname": ticker + " Inc",
+                     "startdatetime": "{}-{:02d}-15T21:00:00.000Z".format(2012 + i // 4, month),
+                     "startdatetimetype": "AMC", "epsestimate": est, "epsactual": act,
+                     "epssurprisepct": round((act - est) / abs(est) * 100, 2) if est else None,
+                     "gmtOffsetMilliSeconds": 0, "quoteType": "EQUITY"})
+    records[mi.payload_name("earnings_history", ticker)] = {"payload": rows}
+
+    quote, stats, stats_valuation = {}, [], []
+    for key, label, dtype in mi.valuation_schema:
+        if label in quote_labels:
+            quote[label] = _value(rnd, dtype)
+        elif label in stats_valuation_labels:
+            stats_valuation.append([label, _value(rnd, dtype)])
+        else:
+            stats.append([label, _value(rnd, dtype)])
+    records[mi.payload_name("quote_table", ticker)] = {"payload": quote}
+    records[mi.payload_name("stats", ticker)] = {"payload": pd.DataFrame(stats, columns=["Attribute", "Value"])}
+    records[mi.payload_name("stats_valuation", ticker)] = {"payload": pd.DataFrame(stats_valuation)}
+
+    dates = pd.to_datetime(["2021-09-25", "2020-09-26", "2019-09-28", "2018-09-29"])
+    for method, index in financial_rows.items():
+        values = [[rnd.uniform(-1, 10) * 1e9 for _ in dates] for _ in index]
+        df = pd.DataFrame(values, index=index, columns=dates).rename_axis("endDate", axis=1)
+        records[mi.payload_name(method, ticker, yearly=True)] = {"payload": df}
+    return records
+
+def record_payloads(tickers, payload_dir):
+    """Save synthetic payloads of `tickers` in `payload_dir` for mi.ReplaySource"""
+    for ticker in tickers:
+        for name, record in synthetic_payloads(ticker).items():
+            mi.save_pickle(name, record, data_dir=payload_dir)
+
+def stages(tickers, workers, plot_tickers):
+    """Return [(stage name, function)] of the pipeline on `tickers`.
+    Fetch stages come first so that the later stages work on the cache.
+    """
+    def earnings():
+        return mi.get_earnings_history(tickers, n_workers=workers)
+
+    def beat_ratio():
+        return mi._show_beat_ratio(mi.get_eps_features(tickers, n_workers=workers), last=20, threshold=80, min_qtrs=4)
+
+    def plot_eps():
+        mi.plot_eps_history(tickers[:plot_tickers])
+        plt.close("all")
+
+    return [
+        ("get_earnings_history", earnings),
+        ("get_valuation", lambda: mi.get_valuation(tickers, n_workers=workers)),
+        ("get_financial_history", lambda: mi.get_financial_history(tickers, n_workers=workers)),
+        ("show_valuation", lambda: mi.show_valuation(tickers, hist=False, table=True)),
+        ("show_beat_ratio", beat_ratio),
+        ("screen", lambda: mi.screen("PSR < 10 and BEAT_RATIO >= 80")),
+        ("plot_eps_history", plot_eps),
+    ]
+
+def _clear_memory():
+    mi.clear_memory_cache()
+    mi._screen_tables.clear()
+
+def run_pass(tickers, cache_dir, workers, plot_tickers, trace=False):
+    """Run cold, warm and hot passes of all stages in a new `cache_dir`.
+    Returns {"cold.<stage>": seconds or peak bytes if `trace`}.
+    """
+    mi.cache_dir = cache_dir
+    _clear_memory()
+    results = {}
+    for mode in ["cold", "warm", "hot"]:
+        if mode == "warm":
+            _clear_memory()
+        for name, fn in stages(tickers, workers, plot_tickers):
+            if trace:
+                tracemalloc.start()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()): # the stages print tables
+                fn()
+            seconds = time.perf_counter() - start
+            if trace:
+                results["{}.{}".format(mode, name)] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                results["{}.{}".format(mode, name)] = seconds
+    return results
+
+def bench(n, work_dir, repeat=1, workers=8, plot_tickers=16, memory=True,
+          latency=0.0, jitter=0.0, error_rate=0.0, verbose=True):
+    """Benchmark the pipeline on `n` tickers and return a list of result records.
+    `latency`, `jitter` and `error_rate` are those of mi.ReplaySource.
+    """
+    tickers = universe(n)
+    payload_dir = os.path.join(work_dir, "payloads_{}".format(n))
+    verbose and print("recording payloads of {} tickers".format(n))
+    record_payloads(tickers, payload_dir)
+
+    times = {}
+    for i in range(repeat):
+        mi.data_source = mi.ReplaySource(payload_dir, latency=latency, jitter=jitter, error_rate=error_rate, seed=i)
+        result = run_pass(tickers, os.path.join(work_dir, "cache_{}_{}".format(n, i)), workers, plot_tickers)
+        for stage, seconds in result.items():
+            times.setdefault(stage, []).append(seconds)
+    peaks = {}
+    if memory:
+        mi.data_source = mi.ReplaySource(payload_dir, latency=latency, jitter=jitter, error_rate=error_rate, seed=0)
+        peaks = run_pass(tickers, os.path.join(work_dir, "cache_{}_trace".format(n)), workers, plot_tickers, trace=True)
+
+    records = []
+    for stage, seconds in times.items():
+        records.append({"tickers": n, "stage": stage, "seconds": seconds, "min": min(seconds),
+                        "median": statistics.median(seconds), "peak_bytes": peaks.get(stage)})
+        verbose and print("{:>6} {:<30} {:9.4f} s  {:>10} KiB".format(
+            n, stage, min(seconds), "-" if stage not in peaks else peaks[stage] // 1024))
+    return records
+
+def compare(records, baseline, tolerance):
+    """Print stages slower than `baseline` by more than `tolerance` (ratio) and return them"""
+    base = {(r["tickers"], r["stage"]): r["min"] for r in baseline["results"]}
+    slower = []
+    for r in records:
+        old = base.get((r["tickers"], r["stage"]))
+        if old:
+            ratio = r["min"] / old
+            flag = " <- slower" if ratio > tolerance else ""
+            print("{:>6} {:<30} {:9.4f} s  x{:.2f}{}".format(r["tickers"], r["stage"], r["min"], ratio, flag))
+            if ratio > tolerance:
+                slower.append(r)
+    return slower
+
+def environment():
+    versions = {"python": platform.python_version(), "pandas": pd.__version__}
+    if mi.pa is not None:
+        versions["pyarrow"] = mi.pa.__version__
+    return dict(versions, date=mi.today(time=True), platform=platform.platform(),
+                cpu_count=os.cpu_count(), cache_format=mi.cache_format)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the mystock_info pipeline on synthetic payloads")
+    parser.add_argument("--sizes", default="10,100,5000", help="numbers of tickers (comma separated)")
+    parser.add_argument("--repeat", type=int, default=1, help="timed passes of each size")
+    parser.add_argument("--workers", type=int, default=8, help="n_workers of the fetch functions")
+    parser.add_argument("--plot-tickers", type=int, default=16, help="tickers drawn by plot_eps_history")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of each replayed request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random seconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a replayed request error")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--format", choices=["parquet", "pickle"], default=mi.cache_format,
+                        help="cache format (mi.cache_format)")
+    parser.add_argument("--out", help="JSON file of the results")
+    parser.add_argument("--baseline", help="JSON file of earlier results to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="ratio to the baseline reported as slower")
+    parser.add_argument("--work-dir", help="directory of payloads and cache (a temporary one if omitted)")
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_mystock_info_")
+    mi.fetch_backoff = 0.01
+    mi.cache_format = args.format
+    records = []
+    try:
+        for n in [int(size) for size in args.sizes.split(",")]:
+            records += bench(n, work_dir, repeat=args.repeat, workers=args.workers,
+                             plot_tickers=args.plot_tickers, memory=not args.no_memory,
+                             latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {"environment": environment(), "options": vars(args), "results": records}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(output, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(records, json.load(f), args.tolerance)
+        return 1 if slower else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
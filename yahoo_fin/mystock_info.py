@@ -1,21 +1,107 @@
 import yahoo_fin.stock_info as si
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+import abc
+import json
 import pickle
+import random
+import re
+import requests
+import sqlite3
 import time
+import zlib
 
 #from IPython.core.display import display
 from IPython.display import display
 
 import os.path, time
+import functools
+import hashlib
+import sys
+import heapq
+import threading
+from contextlib import ExitStack, contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timedelta
 from pathlib import Path
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+    import pyarrow.compute as pc
+    from pyarrow import fs as pafs
+except ImportError: # pickle cache only
+    pa = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import fcntl
+except ImportError: # no lock between processes (Windows)
+    fcntl = None
+
 # Basic definitions
 
 cache_dir = "cache"
 
+# "parquet": a few columnar files of many tickers per data type (cache/<type>/_part<k>.parquet).
+#            Data of a ticker are saved in a small file (cache/<type>/<TICKER>.pkl) until
+#            compact_cache() merges them into the columnar files.
+# "pickle" : one pickle file per ticker and data type (cache/<TICKER>_<type>.pkl)
+cache_format = "parquet" if pa is not None else "pickle"
+
+# number of small files of a data type merged into its columnar files after downloads or before a scan
+compact_files = 50
+
+# byte budget of the in-memory LRU cache in front of the cache files (0 disables it)
+memory_cache_bytes = 256 * 2**20
+
+# number of tickers fetched concurrently by get_data() (1: one by one)
+default_workers = 1
+
+# return expired cache data at once and download new data in background threads
+stale_while_revalidate = False
+refresh_workers = 4
+
+# retries of a failed Yahoo request and the first wait (seconds, doubled at each retry)
+fetch_retries = 2
+fetch_backoff = 1.0
+
+# number of days the validity of a ticker checked by check_ticker() is trusted
+ticker_check_days = 30
+
+# errors of network or Yahoo servers which do not tell if a ticker is valid
+transient_errors = (requests.exceptions.RequestException, OSError)
+
+# maximum number of requests per second to the data source shared by threads (None: no limit)
+request_rate = None
+
+# version of the format of cache data recorded in the manifest and cache files
+#   1: raw pickle / parquet files
+#   2: compressed pickle container with a version header / zstd parquet with version metadata
+#   3: valuation data have "number" column of the values parsed into float
+#   4: valuation data are a typed one-row dataframe of a ticker
+#   5: columns of valuation data are stable metric keys (see valuation_schema)
+#   6: columns of unknown valuation labels are always string
+#   7: eps_yoy of EPS features compares the same quarter a year before, surprise_vol skips missing surprises,
+#      EPS features have companyshortname
+cache_version = 7
+
+# compression of pickle cache files: "zstd", "lz4", "zlib" or None
+cache_compression = "zstd" if zstandard is not None else "lz4" if lz4 is not None else "zlib"
+
 def defaultPlotting():
     sns.set_theme(
         rc={
@@ -36,39 +122,673 @@ def today(time=False):
     else:
         return datetime.today().strftime("%Y-%m-%d")
 
-def save_pickle(dfname, obj, data_dir=cache_dir):
+## profiling
+# Set `profiling = True` or use `with profile():` to record wall time, counts and bytes of
+# stages such as fetch.<method> (network), check_ticker, load_cache, parse_valuation and
+# show_valuation for each stage and ticker. See profile_summary() and export_profile().
+# Stages are nested (e.g. get_data includes fetch.*) and times of threads are summed up.
+profiling = False
+_profile_stages = {}  # stage -> [count, seconds, bytes]
+_profile_tickers = {} # (stage, ticker) -> [count, seconds, bytes]
+_profile_lock = threading.Lock()
+
+def record_stage(name, seconds=0.0, nbytes=0, ticker=None):
+    """Add a call of stage `name` taking `seconds` and `nbytes` bytes to the profile"""
+    with _profile_lock:
+        for table, key in [(_profile_stages, name), (_profile_tickers, (name, ticker))]:
+            if table is _profile_tickers and ticker is None:
+                continue
+            entry = table.setdefault(key, [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += nbytes or 0
+
+class _Stage:
+    __slots__ = ("name", "ticker", "nbytes", "start")
+
+    def __init__(self, name, ticker=None, nbytes=0):
+        self.name, self.ticker, self.nbytes = name, ticker, nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.name, time.perf_counter() - self.start, self.nbytes, self.ticker)
+
+class _NoStage:
+    """Stage doing nothing while `profiling` is False"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+_no_stage = _NoStage()
+
+def stage(name, ticker=None, nbytes=0):
+    """Return a context manager recording the wall time of the block as stage `name`.
+    Bytes can be set by `nbytes` or the `nbytes` attribute of the returned object.
+
+    Usage:
+        with stage("parse_valuation", ticker) as s:
+            ...
+            s.nbytes = len(data)
+    """
+    return _Stage(name, ticker, nbytes) if profiling else _no_stage
+
+def profiled(name):
+    """Decorator recording calls of the function as stage `name`"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not profiling:
+                return fn(*args, **kwargs)
+            with _Stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def reset_profile():
+    with _profile_lock:
+        _profile_stages.clear()
+        _profile_tickers.clear()
+
+@contextmanager
+def profile(reset=True):
+    """Record stages in the block
+
+    Usage:
+        with profile():
+            show_valuation(tickers)
+        print(profile_summary())
+    """
+    global profiling
+    if reset:
+        reset_profile()
+    enabled, profiling = profiling, True
+    try:
+        yield
+    finally:
+        profiling = enabled
+
+def profile_summary(by="stage"):
+    """Return the profile as a dataframe sorted by time
+
+    Args:
+        by(str): "stage" for a row per stage or "ticker" for a row per stage and ticker
+    """
+    with _profile_lock:
+        table = dict(_profile_stages if by == "stage" else _profile_tickers)
+    df = pd.DataFrame([[*([key] if by == "stage" else key), *value] for key, value in table.items()],
+                      columns=(["stage"] if by == "stage" else ["stage", "ticker"]) + ["count", "seconds", "bytes"])
+    df["ms/call"] = df["seconds"] * 1000 / df["count"]
+    return df.sort_values("seconds", ascending=False, ignore_index=True)
+
+def export_profile(fname=None):
+    """Return the profile as JSON text and write it in `fname` if given"""
+    with _profile_lock:
+        data = {
+            "stages": {key: dict(zip(["count", "seconds", "bytes"], value)) for key, value in _profile_stages.items()},
+            "tickers": [dict(zip(["stage", "ticker", "count", "seconds", "bytes"], [*key, *value]))
+                        for key, value in _profile_tickers.items()],
+        }
+    text = json.dumps(data, indent=1)
+    if fname is not None:
+        with open(fname, "w") as f:
+            f.write(text)
+    return text
+
+# sqlite database in cache_dir shared by threads and processes
+_db_local = threading.local()
+_db_schema = """
+CREATE TABLE IF NOT EXISTS tickers (
+    ticker  TEXT PRIMARY KEY,
+    valid   INTEGER NOT NULL,
+    checked REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    key     TEXT PRIMARY KEY,
+    type    TEXT NOT NULL,
+    ticker  TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    nrows   INTEGER,
+    nbytes  INTEGER,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_type ON entries (type, fetched);
+CREATE TABLE IF NOT EXISTS scan_progress (
+    scan    TEXT NOT NULL,
+    ticker  TEXT NOT NULL,
+    status  TEXT NOT NULL,
+    name    TEXT,
+    ratio   REAL,
+    beat    INTEGER,
+    count   INTEGER,
+    checked REAL NOT NULL,
+    PRIMARY KEY (scan, ticker)
+);
+"""
+
+def _db():
+    """Return the connection of this thread to cache/cache.sqlite"""
+    fname = os.path.abspath(cache_dir + "/cache.sqlite")
+    key = (fname, os.getpid()) # a connection must not be shared with forked processes
+    if getattr(_db_local, "key", None) != key:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(fname, timeout=60, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.executescript(_db_schema)
+        _db_local.con, _db_local.key = con, key
+    return _db_local.con
+
+def split_name(dfname):
+    """Split cache name `dfname` (e.g. "SQ_financial_y") into ticker and data type"""
+    ticker, _, type = dfname.partition("_")
+    return ticker, type
+
+def cache_path(dfname, data_dir=None, format=None):
+    """Return the cache file name of `dfname` in `format` (default: `cache_format`).
+    For the parquet cache, it is the small file of the ticker not merged into the columnar files yet.
+    """
+    data_dir = data_dir or cache_dir
+    format = format or cache_format
+    if format == "parquet":
+        ticker, type = split_name(dfname)
+        return "{}/{}/{}.pkl".format(data_dir, type, ticker)
+    return "{}/{}.pkl".format(data_dir, dfname)
+
+def _legacy_path(dfname, data_dir=None):
+    """Return the parquet file of a ticker saved by older versions (cache/<type>/<TICKER>.parquet)"""
+    ticker, type = split_name(dfname)
+    return "{}/{}/{}.parquet".format(data_dir or cache_dir, type, ticker)
+
+# number of columnar files of a data type in the parquet cache
+_cache_parts = 4
+
+def part_path(type, part, data_dir=None):
+    """Return the columnar file `part` of data `type` in the parquet cache"""
+    return "{}/{}/_part{}.parquet".format(data_dir or cache_dir, type, part)
+
+def _part(ticker):
+    return zlib.crc32(ticker.encode()) % _cache_parts
+
+@contextmanager
+def _atomic_write(fname):
+    """Yield a temporary file name which replaces `fname` at the end of the block,
+    so that readers never see a partially written file."""
+    tmp = "{}.{}-{}.tmp".format(fname, os.getpid(), threading.get_ident())
+    try:
+        yield tmp
+        os.replace(tmp, fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+@contextmanager
+def cache_lock(dfname):
+    """Hold the advisory lock of cache data `dfname` (cache/locks/<dfname>.lock)
+    shared by threads and processes."""
+    lock_dir = cache_dir + "/locks"
+    Path(lock_dir).mkdir(parents=True, exist_ok=True)
+    with open("{}/{}.lock".format(lock_dir, dfname), "w") as f:
+        fcntl is not None and fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl is not None and fcntl.flock(f, fcntl.LOCK_UN)
+
+# header of pickle cache files: magic, version and compression (see _codecs)
+_magic = b"MSIC"
+_codecs = {None: 0, "zlib": 1, "lz4": 2, "zstd": 3}
+
+def _compress(data, compression):
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if compression == "lz4":
+        return lz4.frame.compress(data)
+    if compression == "zlib":
+        return zlib.compress(data, 1)
+    return data
+
+def _decompress(data, codec):
+    if codec == _codecs["zstd"]:
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == _codecs["lz4"]:
+        return lz4.frame.decompress(data)
+    if codec == _codecs["zlib"]:
+        return zlib.decompress(data)
+    return data
+
+def save_pickle(dfname, obj, data_dir=None):
     """Save obj in the pickle format in `data_dir`.
     if obj is None, empty dataframe is saved.
+    The pickle is compressed with `cache_compression` after a header of
+    the magic number, `cache_version` and the compression.
 
     Args:
         dfname (str): Name of file
         obj (object): Object to be saved
         data_dir: place where the object is saved. Default is defined as .cache_dir
-
-    Returns:
-        int: Sum of param1 and param2.
-
-    Examples:
-        Examples should be written in doctest format, and should illustrate how
-        to use the function.
-
-        >>> example_function(4, 5)])
-        9
-
     """
     if obj is None:
         obj=pd.DataFrame()
 
+    data_dir = data_dir or cache_dir
     Path(data_dir).mkdir(parents=True, exist_ok=True)
-    fname = data_dir + "/{}.pkl".format(dfname)
-    pickle.dump(obj, open(fname, "wb"))
-
-def load_pickle(dfname, data_dir=cache_dir):
+    fname = cache_path(dfname, data_dir, format="pickle")
+    data = _compress(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), cache_compression)
+    with _atomic_write(fname) as tmp, open(tmp, "wb") as f:
+        f.write(_magic + bytes([cache_version, _codecs[cache_compression]]))
+        f.write(data)
+
+def _load_pickle(dfname, data_dir=None):
+    """Return the object in pickle cache file `dfname` and its format version"""
+    fname = cache_path(dfname, data_dir, format="pickle")
+    with open(fname, "rb") as f:
+        data = f.read()
+    if not data.startswith(_magic): # raw pickle of version 1
+        return pickle.loads(data), 1
+    version, codec = data[len(_magic)], data[len(_magic) + 1]
+    return pickle.loads(_decompress(data[len(_magic) + 2:], codec)), version
+
+def load_pickle(dfname, data_dir=None):
     """Load data from `dfname` in `data_dir`"""
-    fname = "{}/{}.pkl".format(data_dir, dfname)
-    obj = pickle.load(open(fname, "rb"))
+    obj, _ = _load_pickle(dfname, data_dir=data_dir)
     return(obj)
 
+def _arrow_safe(df):
+    """Return a copy of `df` which can be written in parquet.
+    Duplicated columns are dropped and object columns of mixed types
+    (e.g. "2.1T" and 123.4 in valuation data) are converted to str.
+    """
+    df = df.loc[:, ~df.columns.duplicated()].copy()
+    df.columns = [str(col) for col in df.columns]
+    for col in df.columns[df.dtypes == object]:
+        if df[col].dropna().map(type).nunique() > 1:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+def save_parquet(dfname, df, data_dir=None):
+    """Save dataframe `df` in the parquet cache as the small file of the ticker
+    (cache/<type>/<TICKER>.pkl), which `compact_cache()` merges into the columnar files.
+    if df is None, empty dataframe is saved.
+    """
+    ticker, type = split_name(dfname)
+    save_pickle(ticker, df, data_dir="{}/{}".format(data_dir or cache_dir, type))
+    legacy = _legacy_path(dfname, data_dir)
+    if os.path.exists(legacy):
+        os.remove(legacy)
+
+def _write_parquet(fname, df):
+    """Write `df` in parquet file `fname` with the format version in the metadata"""
+    Path(fname).parent.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(_arrow_safe(df), preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"mystock_info.version"] = str(cache_version).encode()
+    table = table.replace_schema_metadata(metadata)
+    with _atomic_write(fname) as tmp:
+        pq.write_table(table, tmp, compression="zstd")
+
+def _parquet_version(schema):
+    return int((schema.metadata or {}).get(b"mystock_info.version", b"1"))
+
+def _read_small(fname):
+    """Return the dataframe in the small file `fname` of a ticker and its format version"""
+    if fname.endswith(".parquet"):
+        table = pq.read_table(fname, memory_map=True)
+        return table.to_pandas(), _parquet_version(table.schema)
+    return _load_pickle(os.path.basename(fname)[:-len(".pkl")], data_dir=os.path.dirname(fname))
+
+def _read_part(type, part, tickers, columns=None, data_dir=None):
+    """Return rows of `tickers` in the columnar file `part` of data `type` and its format version"""
+    pf = pq.ParquetFile(part_path(type, part, data_dir), memory_map=True)
+    names = pf.schema_arrow.names
+    if "ticker" not in names: # no data of any ticker
+        return pd.DataFrame(), _parquet_version(pf.schema_arrow)
+    if columns is not None:
+        names = [col for col in names if col in columns or col == "ticker"]
+    table = pf.read(columns=names)
+    table = table.filter(pc.is_in(table["ticker"], value_set=pa.array(tickers, type=table["ticker"].type)))
+    df = table.to_pandas()
+    if columns is not None and "ticker" not in columns:
+        df = df.drop(columns="ticker")
+    return df, _parquet_version(pf.schema_arrow)
+
+def _load_parquet(dfname, data_dir=None, columns=None):
+    """Return the dataframe of cache data `dfname` in the parquet cache and its format version.
+    It is read from the small file of the ticker if any or the columnar file of the type.
+    """
+    for fname in [cache_path(dfname, data_dir, format="parquet"), _legacy_path(dfname, data_dir)]:
+        try:
+            df, version = _read_small(fname)
+        except FileNotFoundError: # merged into the columnar file
+            continue
+        return (df if columns is None else df[[col for col in columns if col in df.columns]]), version
+    ticker, type = split_name(dfname)
+    return _read_part(type, _part(ticker), [ticker], columns=columns, data_dir=data_dir)
+
+def load_parquet(dfname, data_dir=None, columns=None):
+    """Load dataframe `dfname` from the parquet cache with memory-mapped read"""
+    df, _ = _load_parquet(dfname, data_dir=data_dir, columns=columns)
+    return df
+
+def save_cache(dfname, obj, data_dir=None, fetched=None):
+    """Save `obj` as cache data `dfname` in `cache_format` and record it in the manifest.
+
+    Args:
+        fetched(float): time (unix time) the data was downloaded. Default is now.
+    """
+    with stage("save_cache", split_name(dfname)[0]) as s:
+        if cache_format == "parquet":
+            save_parquet(dfname, obj, data_dir=data_dir)
+        else:
+            save_pickle(dfname, obj, data_dir=data_dir)
+
+        if data_dir is None:
+            nrows = 0 if obj is None else len(obj)
+            s.nbytes = nbytes = os.path.getsize(cache_path(dfname))
+            _manifest_put(dfname, time.time() if fetched is None else fetched, nrows, nbytes)
+
+def load_cache(dfname, data_dir=None):
+    """Load cache data `dfname` saved in `cache_format`.
+    Data saved in an older format version are converted by `_migrations`
+    and saved again in the current version.
+    """
+    with stage("load_cache", split_name(dfname)[0]) as s:
+        if cache_format == "parquet":
+            obj, version = _load_parquet(dfname, data_dir=data_dir)
+        else:
+            obj, version = _load_pickle(dfname, data_dir=data_dir)
+        if profiling:
+            fname = cache_path(dfname, data_dir)
+            s.nbytes = os.path.getsize(fname) if os.path.isfile(fname) else _sizeof(obj)
+
+    if version < cache_version:
+        obj = _migrate(dfname, obj, version)
+        fetched = cache_stamp(dfname) if data_dir is None else None
+        save_cache(dfname, obj, data_dir=data_dir, fetched=fetched)
+    return obj
+
+# functions converting cache data of a type from a version to the next version:
+#   {(type, version): function(obj) -> obj}
+# versions without a function changed only the file format
+_migrations = {}
+
+def _migrate(dfname, obj, version):
+    ticker, type = split_name(dfname)
+    for v in range(version, cache_version):
+        fn = _migrations.get((type, v))
+        if fn is not None and obj is not None and len(obj) != 0:
+            obj = fn(obj)
+    return obj
+
+def _file_version(fname):
+    """Return the format version of cache file `fname` without loading the data"""
+    if fname.endswith(".parquet"):
+        return _parquet_version(pq.read_schema(fname))
+    with open(fname, "rb") as f:
+        header = f.read(len(_magic) + 1)
+    return header[-1] if header.startswith(_magic) else 1
+
+## manifest of cache data (entries table of cache/cache.sqlite)
+
+def _manifest_put(dfname, fetched, nrows, nbytes, version=None):
+    ticker, type = split_name(dfname)
+    _db().execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                  (dfname, type, ticker, fetched, nrows, nbytes, version or cache_version))
+
+def _manifest_drop(dfname):
+    _db().execute("DELETE FROM entries WHERE key = ?", (dfname,))
+
+def cache_stamp(dfname, verbose=False):
+    """Return the time (unix time) cache data `dfname` was downloaded, None if no cache exists.
+    Cache files not recorded in the manifest (saved by older versions) are recorded
+    with their time stamps.
+    """
+    row = _db().execute("SELECT fetched FROM entries WHERE key = ?", (dfname,)).fetchone()
+    if row is not None:
+        return row[0]
+
+    fname = cache_path(dfname)
+    if cache_format == "parquet" and not os.path.isfile(fname) and os.path.isfile(_legacy_path(dfname)):
+        fname = _legacy_path(dfname)
+    if not os.path.isfile(fname) and not _migrate_pickle(dfname, verbose=verbose):
+        return None
+    fetched = os.path.getmtime(fname)
+    _manifest_put(dfname, fetched, None, os.path.getsize(fname), version=_file_version(fname))
+    return fetched
+
+def _is_fresh(fetched, clear_cache):
+    return clear_cache is False or time.time() - fetched <= clear_cache * 86400
+
+def fresh_caches(type, tickers, clear_cache=1, verbose=False):
+    """Return {ticker: downloaded time} of `tickers` having cache data of `type` within `clear_cache` days.
+    The manifest is read in one query. Only tickers not recorded in the manifest are
+    looked up in the cache directory.
+    """
+    rows = _db().execute("SELECT ticker, fetched FROM entries WHERE type = ?", (type,)).fetchall()
+    known = dict(rows)
+    fresh = {}
+    for ticker in tickers:
+        fetched = known.get(ticker)
+        if fetched is None:
+            fetched = cache_stamp(ticker + "_" + type, verbose=verbose)
+        if fetched is not None and _is_fresh(fetched, clear_cache):
+            fresh[ticker] = fetched
+    return fresh
+
+def outdated_caches(type):
+    """Return the set of tickers of which cache data of `type` are saved in an older format version"""
+    rows = _db().execute("SELECT ticker FROM entries WHERE type = ? AND version < ?", (type, cache_version))
+    return {row[0] for row in rows}
+
+def cached_tickers(type):
+    """Return tickers having cache data of `type` (including expired data)"""
+    rows = _db().execute("SELECT ticker FROM entries WHERE type = ? AND (nrows IS NULL OR nrows > 0) ORDER BY ticker",
+                         (type,))
+    return [row[0] for row in rows]
+
+def plan_refresh(type, tickers, clear_cache=1):
+    """Return tickers of which cache data of `type` is missing or older than `clear_cache` days"""
+    fresh = fresh_caches(type, tickers, clear_cache=clear_cache)
+    return [ticker for ticker in tickers if ticker not in fresh]
+
+def cache_entries(type=None):
+    """Return the manifest (key, type, ticker, fetched time, rows, bytes and format version)
+    of cache data as a dataframe"""
+    query = "SELECT * FROM entries" + (" WHERE type = ?" if type else "")
+    df = pd.read_sql_query(query, _db(), params=(type,) if type else None)
+    df["fetched"] = pd.to_datetime(df["fetched"], unit="s")
+    return df
+
+def _migrate_pickle(dfname, verbose=False):
+    """Convert old cache/<dfname>.pkl into the parquet cache keeping its time stamp.
+    Returns True if converted.
+    """
+    fname = cache_path(dfname, format="pickle")
+    if cache_format != "parquet" or not os.path.isfile(fname):
+        return False
+
+    verbose and print("converting {} into parquet".format(fname))
+    obj, version = _load_pickle(dfname)
+    save_cache(dfname, _migrate(dfname, obj, version), fetched=os.path.getmtime(fname))
+    os.remove(fname)
+    return True
+
+def _small_files(type, data_dir=None):
+    """Return {ticker: file} of the small files of data `type` not merged into the columnar files
+    (cache/<type>/<TICKER>.pkl and cache/<type>/<TICKER>.parquet saved by older versions)"""
+    type_dir = "{}/{}".format(data_dir or cache_dir, type)
+    files = {}
+    if not os.path.isdir(type_dir):
+        return files
+    for entry in os.scandir(type_dir):
+        ticker, ext = os.path.splitext(entry.name)
+        if not ticker.startswith("_") and (ext == ".pkl" or ext == ".parquet" and ticker not in files):
+            files[ticker] = entry.path
+    return files
+
+def scan_cache(type, tickers, columns=None, data_dir=None):
+    """Read parquet cache data of `tickers` from the small files of tickers not merged yet
+    and the columnar files of the type (each file is read once).
+    If there are `compact_files` small files or more, they are merged first (see `compact_cache()`).
+
+    Args:
+        type(str): data type such as "earnings", "valuation" or "financial_y"
+        tickers(list): ticker names
+        columns(list): columns to be read. All columns are read if None.
+    Returns:
+        dataframe of all `tickers` (tickers without data have no rows).
+        Rows of a ticker are contiguous.
+    """
+    if len(tickers) == 0:
+        return pd.DataFrame()
+    small = _small_files(type, data_dir)
+    if data_dir is None and len(small) >= compact_files:
+        compact_cache(type)
+        small = _small_files(type)
+
+    frames, parts = [], {}
+    with stage("scan_cache") as s:
+        for ticker in tickers:
+            if ticker in small:
+                try:
+                    df, _ = _read_small(small[ticker])
+                    frames.append(df if columns is None else df[[col for col in columns if col in df.columns]])
+                    continue
+                except FileNotFoundError: # merged meanwhile
+                    pass
+            parts.setdefault(_part(ticker), []).append(ticker)
+        for part, names in sorted(parts.items()):
+            try:
+                df, _ = _read_part(type, part, names, columns=columns, data_dir=data_dir)
+            except FileNotFoundError: # removed by hand
+                for ticker in names:
+                    data_dir is None and _manifest_drop(ticker + "_" + type)
+                continue
+            frames.append(df)
+        frames = [df for df in frames if len(df) != 0]
+        s.nbytes = sum(_sizeof(df) for df in frames)
+    return pd.concat(frames, ignore_index=True) if len(frames) != 0 else pd.DataFrame()
+
+def compact_cache(type, verbose=False):
+    """Merge the small files of data `type` into the columnar files of the parquet cache.
+    Rows of a ticker in a columnar file are replaced by those of its small file, and
+    the small file is removed unless the ticker was saved again meanwhile.
+    """
+    if cache_format != "parquet":
+        return
+    with cache_lock("compact_" + type):
+        parts = {}
+        for ticker, fname in _small_files(type).items():
+            parts.setdefault(_part(ticker), {})[ticker] = fname
+        for part, files in sorted(parts.items()):
+            fname = part_path(type, part)
+            verbose and print("merging {} files of {} into {}".format(len(files), type, fname))
+            frames, merged = [], {}
+            for ticker, small in files.items():
+                try:
+                    stat = os.stat(small)
+                    df, version = _read_small(small)
+                except FileNotFoundError:
+                    continue
+                merged[ticker] = stat
+                df = _migrate(ticker + "_" + type, df, version)
+                if df is not None and len(df) != 0:
+                    if "ticker" not in df.columns or (df["ticker"] != ticker).any(): # rows are found by ticker
+                        df = df.assign(ticker=ticker)
+                    frames.append(df)
+
+            if os.path.isfile(fname):
+                table = pq.read_table(fname, memory_map=True)
+                old, version = table.to_pandas(), _parquet_version(table.schema)
+                if "ticker" in old.columns:
+                    old = old[~old["ticker"].isin(list(merged))]
+                    if version < cache_version and len(old) != 0:
+                        old = pd.concat([_migrate(ticker + "_" + type, tmp.reset_index(drop=True), version)
+                                         for ticker, tmp in old.groupby("ticker", sort=False)], ignore_index=True)
+                    frames.insert(0, old)
+            df = pd.concat(frames, ignore_index=True) if len(frames) != 0 else pd.DataFrame()
+            if "ticker" in df.columns:
+                df = df.sort_values("ticker", kind="stable", ignore_index=True)
+            _write_parquet(fname, df)
+            tickers = set(merged) | (set(df["ticker"]) if "ticker" in df.columns else set())
+            _db().executemany("UPDATE entries SET version = ? WHERE key = ?",
+                              [(cache_version, ticker + "_" + type) for ticker in tickers])
+
+            for ticker, stat in merged.items():
+                _remove_merged(files[ticker], stat)
+
+def _remove_merged(fname, stat):
+    """Remove the small file `fname` merged into a columnar file if it is not saved again after `stat`"""
+    tmp = fname + ".merged"
+    try:
+        os.replace(fname, tmp)
+    except FileNotFoundError:
+        return
+    new = os.stat(tmp)
+    if (new.st_ino, new.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns): # saved again: put it back
+        try:
+            os.link(tmp, fname)
+        except FileExistsError: # saved once more
+            pass
+    os.remove(tmp)
+
+def _unify_schemas(schemas):
+    """Return the schema of parquet files of `schemas`.
+    Columns of which types differ among the files (e.g. number and string) are read as string.
+    """
+    try:
+        if int(pa.__version__.split(".")[0]) >= 14:
+            return pa.unify_schemas(schemas, promote_options="permissive")
+        return pa.unify_schemas(schemas) # null columns of empty data can only be merged
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        pass
+
+    types = {} # non-null types of each column in the order of the columns
+    for schema in schemas:
+        for field in schema:
+            column = types.setdefault(field.name, [])
+            if not pa.types.is_null(field.type) and field.type not in column:
+                column.append(field.type)
+    conflicts = [name for name, column in types.items() if len(column) > 1]
+    print("columns {} have different types in cache files and are read as string".format(conflicts))
+    fields = [pa.field(name, pa.string() if len(column) > 1 else column[0] if column else pa.null())
+              for name, column in types.items()]
+    return pa.schema(fields, metadata=schemas[0].metadata)
+
+def _scan_parquet(paths, columns=None, filter=None):
+    """Read parquet files `paths` (e.g. merged snapshots of the history) in a single dataset scan
+    and return a dataframe. Rows are selected by `filter` (pyarrow expression) if given.
+    """
+    if len(paths) == 0:
+        return pd.DataFrame()
+
+    # memory map the files and unify schemas of the fragments because
+    # the schema of empty (no data) files or of older files can differ
+    filesystem = pafs.LocalFileSystem(use_mmap=True)
+    dataset = ds.dataset(paths, format="parquet", filesystem=filesystem)
+    schemas = [frag.physical_schema for frag in dataset.get_fragments()]
+    schemas = [schema for schema in schemas if len(schema) != 0]
+    if len(schemas) == 0:
+        return pd.DataFrame()
+    schema = _unify_schemas(schemas)
+
+    dataset = ds.dataset(paths, schema=schema, format="parquet", filesystem=filesystem)
+    if columns is not None:
+        columns = [col for col in columns if col in schema.names]
+    with stage("scan_cache") as s:
+        table = dataset.to_table(columns=columns, filter=filter)
+        s.nbytes = table.nbytes
+    with stage("to_pandas", nbytes=table.nbytes):
+        return table.to_pandas()
+
 def isnewfile(dfname, clear_cache=1, verbose=False):
     """Check the existence of the file `dfname`
 
@@ -81,65 +801,506 @@ def isnewfile(dfname, clear_cache=1, verbose=False):
         True if (cache was created within `cache_dir` days) or (cache exists and use it (clear_cache=False))
         False otherwise
     """
-    fname = "{}/{}.pkl".format(cache_dir, dfname)
-
-    if not os.path.isfile(fname):
-        verbose and print("{} not found".format(fname))
+    fetched = cache_stamp(dfname, verbose=verbose)
+    if fetched is None:
+        verbose and print("{} not found".format(dfname))
         return None
 
-    if clear_cache is False:
-        verbose and print("{} is found and preserve cache: {}".format(fname,dfname))
+    if _is_fresh(fetched, clear_cache):
+        verbose and print("you have new file within {} day: {}".format(clear_cache,dfname))
         return True
-    
-    now = datetime.utcnow()
-    file_time = datetime.utcfromtimestamp(os.path.getmtime(fname))
-    if (now - file_time) > timedelta(clear_cache):
+    else:
         verbose and print("more than {} day has passed: {}".format(clear_cache,dfname))
         return False
-    else:
-        verbose and print("you have new file within {} day: {}".format(clear_cache,dfname))
-        return True
 
 
+# in-memory LRU cache: dfname -> (downloaded time of the cache data, bytes, object)
+_memory_cache = OrderedDict()
+_memory_cache_used = 0
+_memory_lock = threading.RLock()
+
+def _sizeof(obj):
+    """Estimate the memory size of `obj` (8 bytes per number and ~64 bytes per string)"""
+    if isinstance(obj, pd.DataFrame):
+        n_text = sum(dtype == object or dtype == "string" for dtype in obj.dtypes)
+        return len(obj) * (8 * obj.shape[1] + 56 * n_text + 8) + 1000
+    return sys.getsizeof(obj)
+
+def _memory_get(dfname, fetched):
+    """Return the object of `dfname` in memory if it is the cache data downloaded at `fetched`"""
+    with _memory_lock:
+        entry = _memory_cache.get(dfname)
+        if entry is None or entry[0] != fetched:
+            return None
+        _memory_cache.move_to_end(dfname)
+        return entry[2]
+
+def _memory_put(dfname, fetched, obj, nbytes=None):
+    """Keep `obj` (`nbytes` bytes, estimated if None) in memory
+    and drop the least recently used objects over `memory_cache_bytes`"""
+    global _memory_cache_used
+    nbytes = _sizeof(obj) if nbytes is None else nbytes
+    with _memory_lock:
+        _memory_drop(dfname)
+        if nbytes <= memory_cache_bytes:
+            _memory_cache[dfname] = (fetched, nbytes, obj)
+            _memory_cache_used += nbytes
+        while _memory_cache_used > memory_cache_bytes:
+            _, (_, nbytes, _) = _memory_cache.popitem(last=False)
+            _memory_cache_used -= nbytes
+
+def _memory_drop(dfname):
+    global _memory_cache_used
+    with _memory_lock:
+        entry = _memory_cache.pop(dfname, None)
+        if entry is not None:
+            _memory_cache_used -= entry[1]
+
+def clear_memory_cache():
+    """Drop all cache data kept in memory"""
+    global _memory_cache_used
+    with _memory_lock:
+        _memory_cache.clear()
+        _memory_cache_used = 0
+
 def get_cache(fname, clear_cache=1, verbose=False):
     """read data from cache
+    Data loaded once are kept in memory (up to `memory_cache_bytes`)
+    until the cache data are downloaded again.
+
     Returns
         Object if dfname is a file within `clear_cache` days.
         None otherwise (no data file).
     """
 
-    if isnewfile(fname, clear_cache=clear_cache, verbose=verbose):
-        verbose and print("loading cache data: {}".format(fname))
-        obj = load_pickle(fname)
-        return obj
+    fetched = cache_stamp(fname, verbose=verbose)
+    if fetched is not None and _is_fresh(fetched, clear_cache):
+        obj = _memory_get(fname, fetched)
+        if obj is None:
+            verbose and print("loading cache data: {}".format(fname))
+            try:
+                obj = load_cache(fname)
+            except FileNotFoundError: # removed by hand
+                _manifest_drop(fname)
+                return None
+            _memory_put(fname, fetched, obj)
+        return obj.copy() if isinstance(obj, pd.DataFrame) else obj
     else:
-        verbose and print("no cache found:".format(fname))
+        verbose and print("no cache found: {}".format(fname))
         return None
     
-def check_ticker(ticker):
-# check if `ticker` is valid (True) or not (False)
-    ret=True
+# background downloads of expired cache data: dfname -> future
+_refresh_executor = None
+_refreshing = {}
+_refresh_lock = threading.Lock()
+
+def _refresh(dfname, fetch, clear_cache, verbose=False):
+    try:
+        with cache_lock(dfname):
+            if get_cache(fname=dfname, clear_cache=clear_cache) is None:
+                verbose and print("refreshing {}".format(dfname))
+                fetch()
+    except Exception as e:
+        print("failed to refresh {}: {}".format(dfname, e))
+    finally:
+        with _refresh_lock:
+            _refreshing.pop(dfname, None)
+
+def _revalidate(dfname, fetch, clear_cache, verbose=False):
+    """Download `dfname` in a background thread unless it is being downloaded"""
+    global _refresh_executor
+    with _refresh_lock:
+        if dfname in _refreshing:
+            return
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(max_workers=refresh_workers)
+        _refreshing[dfname] = _refresh_executor.submit(_refresh, dfname, fetch, clear_cache, verbose)
+
+def wait_refresh(timeout=None):
+    """Wait for the background downloads started by `stale_while_revalidate` mode"""
+    with _refresh_lock:
+        futures = list(_refreshing.values())
+    wait(futures, timeout=timeout)
+
+## data sources
+# Fetch functions get raw payloads from `data_source` instead of calling yahoo_fin.stock_info,
+# so that the pipeline can run offline on recorded payloads:
+#   data_source = RecordingSource(YahooSource(), "payloads") # record payloads of live downloads
+#   data_source = ReplaySource("payloads", latency=0.2, error_rate=0.05) # replay them offline
+
+class DataSource(abc.ABC):
+    """Interface of data sources.
+    A source implements `get(method, ticker, **kwargs)` returning the payload of
+    yahoo_fin.stock_info.get_<method>(ticker, **kwargs) and raising an exception on failure.
+    """
+    @abc.abstractmethod
+    def get(self, method, ticker, **kwargs):
+        """Return the payload of `method` for `ticker`"""
+
+    def request(self, method, ticker, **kwargs):
+        """Call `get()` recording it as stage fetch.<method>, waiting for `request_rate`"""
+        _throttle()
+        with stage("fetch." + method, ticker):
+            return self.get(method, ticker, **kwargs)
+
+    def exchange_tickers(self, exchange):
+        """Return tickers of `exchange` (see `exchanges`)"""
+        return self.request("exchange_tickers", exchange)
+
+    def company_officers(self, ticker):
+        return self.request("company_officers", ticker)
+
+    def earnings_history(self, ticker):
+        return self.request("earnings_history", ticker)
+
+    def quote_table(self, ticker):
+        return self.request("quote_table", ticker)
+
+    def stats(self, ticker):
+        return self.request("stats", ticker)
+
+    def stats_valuation(self, ticker):
+        return self.request("stats_valuation", ticker)
+
+    def cash_flow(self, ticker, yearly=True):
+        return self.request("cash_flow", ticker, yearly=yearly)
+
+    def balance_sheet(self, ticker, yearly=True):
+        return self.request("balance_sheet", ticker, yearly=yearly)
+
+    def income_statement(self, ticker, yearly=True):
+        return self.request("income_statement", ticker, yearly=yearly)
+
+class YahooSource(DataSource):
+    """Live data source downloading from Yahoo Finance with yahoo_fin.stock_info"""
+    def get(self, method, ticker, **kwargs):
+        if method == "exchange_tickers": # e.g. si.tickers_nasdaq()
+            return getattr(si, "tickers_" + ticker)()
+        return getattr(si, "get_" + method)(ticker, **kwargs)
+
+# exchanges (and indices) of which ticker lists are available (e.g. "nasdaq": si.tickers_nasdaq())
+exchanges = ["dow", "ftse100", "ftse250", "ibovespa", "nasdaq", "nifty50", "niftybank", "other", "sp500"]
+
+_throttle_lock = threading.Lock()
+_next_request = 0.0
+
+def _throttle():
+    """Wait until the next request is allowed by `request_rate`"""
+    global _next_request
+    if not request_rate:
+        return
+    with _throttle_lock:
+        now = time.monotonic()
+        wait = _next_request - now
+        _next_request = max(now, _next_request) + 1.0 / request_rate
+    if wait > 0:
+        time.sleep(wait)
+
+class ThrottledSource(DataSource):
+    """Data source sending requests of `source` at most `rate` per second (shared by threads).
+    Unlike `request_rate`, the limit applies only to the callers given this source.
+    """
+    def __init__(self, source, rate):
+        self.source = source
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def get(self, method, ticker, **kwargs):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + 1.0 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+        return self.source.get(method, ticker, **kwargs)
+
+def payload_name(method, ticker, yearly=None):
+    """Return the name of a recorded payload (e.g. "SQ_cash_flow_y")"""
+    suffix = "" if yearly is None else "_y" if yearly else "_q"
+    return "{}_{}{}".format(ticker, method, suffix)
+
+class RecordingSource(DataSource):
+    """Data source saving the payloads (and failures) of `source` in `record_dir` for ReplaySource"""
+    def __init__(self, source, record_dir):
+        self.source = source
+        self.record_dir = record_dir
+
+    def get(self, method, ticker, **kwargs):
+        name = payload_name(method, ticker, kwargs.get("yearly"))
+        try:
+            payload = self.source.get(method, ticker, **kwargs)
+        except Exception as e:
+            save_pickle(name, {"error": repr(e)}, data_dir=self.record_dir)
+            raise
+        save_pickle(name, {"payload": payload}, data_dir=self.record_dir)
+        return payload
+
+class ReplaySource(DataSource):
+    """Offline data source serving payloads recorded in `record_dir` (see RecordingSource).
+
+    Args:
+        latency(float): seconds each request takes
+        jitter(float): random seconds added to `latency` (uniform in [0, jitter])
+        error_rate(float): probability a request fails with ConnectionError
+        seed: seed of the random latency and errors. The n-th request of a payload
+            behaves the same in every run regardless of the order of threads.
+    Payloads not recorded raise ValueError as Yahoo Finance does for unknown tickers.
+    """
+    def __init__(self, record_dir, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.record_dir = record_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.seed = seed
+        self.requests = {} # payload name -> number of requests
+        self._lock = threading.Lock()
+        self._payloads = {}
+
+    def _load(self, name):
+        with self._lock:
+            record = self._payloads.get(name)
+        if record is None:
+            try:
+                record = load_pickle(name, data_dir=self.record_dir)
+            except FileNotFoundError:
+                record = {"error": "no payload {} in {}".format(name, self.record_dir)}
+            with self._lock:
+                self._payloads[name] = record
+        return record
+
+    def get(self, method, ticker, **kwargs):
+        name = payload_name(method, ticker, kwargs.get("yearly"))
+        with self._lock:
+            n = self.requests.get(name, 0)
+            self.requests[name] = n + 1
+        rnd = random.Random("{}:{}:{}".format(self.seed, name, n))
+        time.sleep(self.latency + rnd.uniform(0, self.jitter))
+        if rnd.random() < self.error_rate:
+            raise ConnectionError("replayed error of {}".format(name))
+
+        record = self._load(name)
+        if "error" in record:
+            raise ValueError(record["error"])
+        payload = record["payload"]
+        return payload.copy() if isinstance(payload, pd.DataFrame) else pickle.loads(pickle.dumps(payload))
+
+data_source = YahooSource()
+
+def _retry(fn, *args, **kwargs):
+    """Call `fn(*args, **kwargs)` retrying `fetch_retries` times with exponential backoff.
+    Only `transient_errors` are retried; other errors (e.g. no data of the ticker) are raised at once.
+    """
+    for i in range(fetch_retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except transient_errors:
+            if i == fetch_retries:
+                raise
+            time.sleep(fetch_backoff * 2**i)
+
+def _get_or_fetch(dfname, fetch, clear_cache=1, verbose=False):
+    """Return cache data `dfname` within `clear_cache` days or download it by `fetch()`.
+    `fetch()` saves the data in cache and returns it. Only one thread or process
+    downloads `dfname` at a time. The others wait for it and read the saved data.
+    If `stale_while_revalidate` is True, expired cache data are returned at once
+    and new data are downloaded in background for the next call.
+    """
+    df = get_cache(fname=dfname, clear_cache=clear_cache, verbose=verbose)
+    if df is not None: # True if data file exists (df is empty if no data is available)
+        return df
+
+    if stale_while_revalidate:
+        df = get_cache(fname=dfname, clear_cache=False)
+        if df is not None:
+            verbose and print("using expired cache data: {}".format(dfname))
+            _revalidate(dfname, fetch, clear_cache, verbose=verbose)
+            return df
+
+    with cache_lock(dfname):
+        df = get_cache(fname=dfname, clear_cache=clear_cache)
+        if df is not None:
+            verbose and print("{} was downloaded by another process".format(dfname))
+            return df
+        return fetch()
+
+@profiled("check_ticker")
+def check_ticker(ticker, source=None):
+# check if `ticker` is valid (True) or not (False) with `source` (default: data_source)
+# `transient_errors` are retried like `_retry()` and raised if they persist
+    source = data_source if source is None else source
+    for i in range(fetch_retries + 1):
+        try:
+            source.company_officers(ticker)
+            return True
+        except transient_errors:
+            if i == fetch_retries:
+                raise
+            time.sleep(fetch_backoff * 2**i)
+        except Exception: # no profile of unknown symbols
+            return False
+
+def set_ticker_valid(ticker, valid=True):
+    """Record the validity of `ticker` in the ticker index"""
+    _db().execute("INSERT OR REPLACE INTO tickers VALUES (?, ?, ?)", (ticker, int(valid), time.time()))
+
+def is_valid_ticker(ticker, verbose=False, source=None):
+    """Check if `ticker` is valid using the ticker index.
+    `check_ticker(ticker, source)` is called only if the ticker was not checked within `ticker_check_days` days.
+    Both valid and invalid tickers are recorded. Network errors are raised and not recorded.
+    """
+    row = _db().execute("SELECT valid, checked FROM tickers WHERE ticker = ?", (ticker,)).fetchone()
+    if row is not None and time.time() - row[1] < ticker_check_days * 86400:
+        return bool(row[0])
+
+    verbose and print("checking ticker {}".format(ticker))
+    valid = check_ticker(ticker, source=source)
+    set_ticker_valid(ticker, valid)
+    return valid
+
+
+def _iter_frames(fn, tickers, cache_type=None, columns=None, n_workers=None, ordered=True, **kwargs):
+    """Yield dataframes of `tickers` (see `get_data()` for the arguments).
+    Fresh cache data read in a single scan are yielded as one dataframe of several tickers,
+    other data are yielded one ticker at a time in the order of `tickers` if `ordered`
+    and as soon as they are available otherwise.
+    """
+    if cache_type is not None:
+        clear_cache = kwargs.get("clear_cache", 1)
+        verbose = kwargs.get("verbose", False)
+        fresh = fresh_caches(cache_type, tickers, clear_cache=clear_cache, verbose=verbose)
+        outdated = outdated_caches(cache_type)
+        scan = [ticker for ticker in fresh if ticker not in outdated]
+        for ticker in fresh: # convert data of older versions
+            if ticker in outdated:
+                tmp = get_cache(ticker + "_" + cache_type, clear_cache=False)
+                if tmp is not None and len(tmp) != 0:
+                    yield tmp if columns is None else tmp[[col for col in columns if col in tmp.columns]]
+        # take data kept in memory and read the rest
+        fresh_scan, scan = scan, []
+        for ticker in fresh_scan:
+            tmp = _memory_get(ticker + "_" + cache_type, fresh[ticker])
+            if tmp is None:
+                scan.append(ticker)
+            elif len(tmp) != 0: # a copy as get_cache() because the caller may change it
+                yield (tmp if columns is None else tmp[[col for col in columns if col in tmp.columns]]).copy()
+
+        if cache_format == "parquet":
+            verbose and print("scanning cache of {} tickers".format(len(scan)))
+            df = scan_cache(cache_type, scan, columns=columns)
+            if columns is None and "ticker" in df.columns: # rows of a ticker are contiguous
+                names = df["ticker"].to_numpy()
+                starts = np.flatnonzero(np.append(True, names[1:] != names[:-1]))
+                rows = dict(zip(names[starts], zip(starts, np.append(starts[1:], len(df)))))
+                row_bytes = _sizeof(df) // max(len(df), 1)
+                df = df.copy() # consolidate the blocks once instead of in each slice
+                for ticker in scan:
+                    start, end = rows.get(ticker, (0, 0))
+                    tmp = df.iloc[start:end].reset_index(drop=True)
+                    _memory_put(ticker + "_" + cache_type, fresh[ticker], tmp, nbytes=(end - start) * row_bytes + 1000)
+            if len(df) != 0:
+                yield df
+        else:
+            for ticker in scan:
+                tmp = get_cache(ticker + "_" + cache_type, clear_cache=False)
+                if tmp is not None and len(tmp) != 0:
+                    yield tmp if columns is None else tmp[[col for col in columns if col in tmp.columns]]
+        if len(fresh) != 0: # files removed by hand are downloaded again
+            fresh = fresh_caches(cache_type, list(fresh), clear_cache=clear_cache)
+        tickers = [ticker for ticker in tickers if ticker not in fresh]
+
+    if profiling: # record the time of each ticker
+        fn = functools.partial(_profiled_call, fn)
+    n_workers = min(n_workers or default_workers, len(tickers))
+    if n_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+        futures = [executor.submit(fn, ticker=ticker, **kwargs) for ticker in tickers]
+        results = (future.result() for future in (futures if ordered else as_completed(futures)))
+    else:
+        executor = None
+        results = (fn(ticker=ticker, **kwargs) for ticker in tickers)
+
     try:
-        si.get_company_officers(ticker)
-    except:
-        ret=False
-    return(ret)
+        for tmp in results:
+            if tmp is not None and len(tmp) != 0:
+                tmp=tmp.loc[:,~tmp.columns.duplicated()]# sometimes downloaded df has duplicated columns
+                if columns is not None:
+                    tmp = tmp[[col for col in columns if col in tmp.columns]]
+                yield tmp
+    finally: # the caller may stop before all tickers are done
+        executor is not None and executor.shutdown(wait=False, cancel_futures=True)
+
+    # merge the downloaded data into the columnar files while they are hot in the page cache
+    if (cache_type is not None and cache_format == "parquet" and len(tickers) != 0
+            and len(_small_files(cache_type)) >= compact_files):
+        compact_cache(cache_type)
+
+def _profiled_call(fn, ticker, **kwargs):
+    with _Stage(fn.__name__, ticker):
+        return fn(ticker=ticker, **kwargs)
+
+def _no_fetch(ticker, **kwargs):
+    return None
+
+def read_cache(type, tickers=None, columns=None):
+    """Return cache data of `type` without downloading (expired data are included).
+
+    Args:
+        type(str): data type such as "earnings", "valuation" or "financial_y"
+        tickers(list): ticker names. All tickers in cache if None.
+        columns(list): columns to be read (all columns if None)
+    """
+    if tickers is None:
+        tickers = cached_tickers(type)
+    return get_data(fn=_no_fetch, tickers=tickers, cache_type=type, columns=columns, clear_cache=False)
 
+def iter_data(fn, tickers, cache_type=None, columns=None, n_workers=None, **kwargs):
+    """Yield a dataframe of each ticker as soon as it is available.
 
-def get_data(fn, tickers, **kwargs):
-    tickers.sort()
+    Arguments are the same as `get_data()`. Tickers without data are skipped.
+
+    Usage:
+        for df in iter_data(_get_earnings_history, tickers, cache_type="earnings", n_workers=8):
+            print(df["ticker"].iloc[0], len(df))
+    """
     if isinstance(tickers, str):
         tickers = [tickers]
+    tickers = sorted(ticker.upper() for ticker in tickers)
 
-    df = pd.DataFrame()
-    for ticker in tickers:
-        ticker = ticker.upper()
-        tmp = fn(ticker=ticker, **kwargs)
-        if tmp is not None and len(tmp) != 0:
-            tmp=tmp.loc[:,~tmp.columns.duplicated()]# sometimes downloaded df has duplicated columns
-            #df = df.append(tmp,ignore_index=True)
-            df = pd.concat([df,tmp],ignore_index=True)
+    for df in _iter_frames(fn, tickers, cache_type=cache_type, columns=columns,
+                           n_workers=n_workers, ordered=False, **kwargs):
+        if "ticker" not in df.columns or df["ticker"].nunique() <= 1:
+            yield df
+        else: # single scan of cache data
+            for _, tmp in df.groupby("ticker", sort=False):
+                yield tmp.reset_index(drop=True)
+
+@profiled("get_data")
+def get_data(fn, tickers, cache_type=None, columns=None, n_workers=None, **kwargs):
+    """Call `fn(ticker=ticker, **kwargs)` for each ticker and combine the results.
+
+    Args:
+        fn: function to get data of a ticker such as `_get_earnings_history`
+        tickers(list or str): Ticker name(s)
+        cache_type(str): data type of the cache of `fn` (e.g. "earnings").
+            If given with the parquet cache, fresh cache data of all tickers
+            are read in a single scan and `fn` is called only for the others.
+        columns(list): columns read in the single scan (all columns if None)
+        n_workers(int): number of tickers fetched concurrently (default: `default_workers`).
+            The results are combined in the order of the sorted tickers anyway.
+    """
+    if isinstance(tickers, str):
+        tickers = [tickers]
+    tickers = sorted(ticker.upper() for ticker in tickers)
+
+    frames = list(_iter_frames(fn, tickers, cache_type=cache_type, columns=columns,
+                               n_workers=n_workers, **kwargs))
+    if len(frames) == 0:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
 
+    if cache_type is not None and "ticker" in df.columns:
+        df = df.sort_values(by="ticker", kind="stable", ignore_index=True)
 
     return df
 
@@ -151,12 +1312,14 @@ def get_data(fn, tickers, **kwargs):
 #   df_earnings=get_earnings_history(ticker)
 #   plot_eps_history(df_earnings)
 
-def _get_earnings_history(ticker, clear_cache=1, verbose=False):
+def _get_earnings_history(ticker, clear_cache=1, incremental=False, verbose=False, source=None):
     """
     Args:
         ticker(str): Ticker name
         clear_cache(int): Number of days the cache is valid
+        incremental(bool): update expired cache data only with new or changed quarters
         verbose(bool): verbose mode
+        source(DataSource): source of downloads (default: data_source)
     Returns:
         dataframe of EPS history
         None if no data is available
@@ -166,36 +1329,183 @@ def _get_earnings_history(ticker, clear_cache=1, verbose=False):
     type="earnings"
 
     dfname = ticker + "_" + type
-    df=get_cache(fname=dfname, clear_cache=clear_cache, verbose=verbose)
-    if df is not None: # True if data file exists (df is empty if no data is available)
-        return(df)
-    
-    if not check_ticker(ticker):
+    return _get_or_fetch(dfname, lambda: _fetch_earnings_history(ticker, dfname, incremental=incremental,
+                                                                       verbose=verbose, source=source),
+                         clear_cache=clear_cache, verbose=verbose)
+
+def _new_earnings_rows(dct, df_old):
+    """Return raw EPS history rows in `dct` which are not in `df_old`,
+    i.e. rows on or after the last reported quarter of `df_old` and rows with changed EPS.
+    """
+    last = df_old["startdatetime"].max().strftime("%Y-%m-%d")
+    known = set(zip(df_old["startdatetime"].dt.strftime("%Y-%m-%d"), df_old["epsestimate"], df_old["epsactual"]))
+    rows = []
+    for row in dct:
+        date = (row.get("startdatetime") or "")[:10]
+        if date >= last or (date, row.get("epsestimate"), row.get("epsactual")) not in known:
+            rows.append(row)
+    return rows
+
+def _save_earnings(ticker, dfname, df, features=None):
+    """Save EPS history `df` of `ticker` as cache data `dfname` and its feature table
+    (`features` or made by `eps_features()`) with the same time stamp.
+    Returns the time stamp."""
+    fetched = time.time()
+    save_cache(dfname=dfname, obj=df, fetched=fetched)
+    if features is None and df is not None and len(df) != 0:
+        features = eps_features(df)
+    save_cache(dfname=ticker + "_eps_features", obj=features, fetched=fetched)
+    return fetched
+
+def normalize_earnings(payloads):
+    """Convert raw EPS history payloads {ticker: list of dicts} of si.get_earnings_history()
+    into one dataframe in a single pass.
+
+    Rows are kept in the order of the payloads. As `pd.json_normalize(dct).dropna()` of
+    each ticker, rows with missing values are dropped, but only for the fields in the
+    payload of the ticker. "startdatetime" (e.g. "2021-07-27T20:00:00.000Z") is converted
+    into the date in one vectorized conversion. "ticker" is set to the key of the payload
+    (the field of Yahoo Finance may differ in case or be missing).
+    """
+    records = [record for dct in payloads.values() for record in dct]
+    if len(records) == 0:
+        return pd.DataFrame()
+    df = pd.json_normalize(records)
+    codes = np.repeat(np.arange(len(payloads)), [len(dct) for dct in payloads.values()])
+
+    fields = [set().union(*dct) for dct in payloads.values()]
+    present = np.array([[col in keys for col in df.columns] for keys in fields], dtype=bool)
+    keep = (df.notna().to_numpy() | ~present[codes]).all(axis=1)
+    df = df[keep].reset_index(drop=True)
+    tickers = np.array(list(payloads), dtype=object)[codes[keep]]
+    if "ticker" in df.columns:
+        df["ticker"] = tickers
+    else:
+        df.insert(0, "ticker", tickers)
+
+    dates = df["startdatetime"].astype(str).str.slice(0, 10)
+    df["startdatetime"] = pd.to_datetime(dates, format="%Y-%m-%d", errors="coerce")
+    return df
+
+def _download_earnings(ticker, verbose=False):
+    """Return raw EPS history of `ticker` from the data source, None if the ticker is invalid"""
+    if not is_valid_ticker(ticker, verbose=verbose):
+        return None
+    return data_source.earnings_history(ticker)
+
+def ingest_earnings(payloads, verbose=False):
+    """Normalize raw EPS history payloads {ticker: list of dicts} in one pass
+    (see `normalize_earnings()`), make their feature tables in one pass and save
+    EPS history and features of each ticker in cache.
+    """
+    with stage("parse_earnings", nbytes=sum(len(dct) for dct in payloads.values())):
+        df = normalize_earnings(payloads)
+        features = eps_features(df) if len(df) != 0 else pd.DataFrame(columns=["ticker"])
+    groups = {} if len(df) == 0 else dict(tuple(df.groupby("ticker", sort=False)))
+    feature_groups = dict(tuple(features.groupby("ticker", sort=False)))
+
+    for ticker in payloads:
+        dfname = ticker + "_earnings"
+        tmp = groups.get(ticker)
+        if tmp is None:
+            print("no data for {}".format(ticker))
+            _save_earnings(ticker, dfname, None)
+            continue
+        tmp = tmp.reset_index(drop=True)
+        fetched = _save_earnings(ticker, dfname, tmp, features=feature_groups[ticker].reset_index(drop=True))
+        _memory_put(dfname, fetched, tmp)
+
+def _refresh_earnings(tickers, clear_cache=1, n_workers=None, chunk=100, verbose=False):
+    """Download EPS histories of `tickers` missing or older than `clear_cache` days
+    and save them with `ingest_earnings()`, `chunk` tickers at a time. Returns True if downloaded.
+
+    As `_get_or_fetch()`, the `cache_lock()` of each ticker is held from download to save
+    and data downloaded by another process meanwhile are used. Histories downloaded
+    successfully are saved even if other tickers fail, then the first error is raised.
+    """
+    tickers = sorted(ticker.upper() for ticker in tickers) # lock order of all processes
+    stale = plan_refresh("earnings", tickers, clear_cache=clear_cache)
+    if len(stale) < 2: # nothing to batch
+        return False
+    verbose and print("downloading EPS histories of {} tickers".format(len(stale)))
+    n_workers = min(n_workers or default_workers, len(stale))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for i in range(0, len(stale), chunk):
+            with ExitStack() as locks:
+                for ticker in stale[i:i + chunk]:
+                    locks.enter_context(cache_lock(ticker + "_earnings"))
+                batch = plan_refresh("earnings", stale[i:i + chunk], clear_cache=clear_cache)
+                n_done = len(stale[i:i + chunk]) - len(batch)
+                verbose and n_done and print("{} tickers were downloaded by another process".format(n_done))
+
+                payloads, errors = {}, {}
+                futures = {ticker: executor.submit(_download_earnings, ticker, verbose=verbose) for ticker in batch}
+                for ticker, future in futures.items():
+                    try:
+                        dct = future.result()
+                    except Exception as e:
+                        errors[ticker] = e
+                        continue
+                    if dct is not None:
+                        payloads[ticker] = dct
+                ingest_earnings(payloads, verbose=verbose)
+
+            for ticker, e in errors.items():
+                print("failed to download EPS history of {}: {!r}".format(ticker, e))
+            if len(errors) != 0:
+                raise next(iter(errors.values()))
+    return True
+
+def _fetch_earnings_history(ticker, dfname, incremental=False, verbose=False, source=None):
+    """Download EPS history of `ticker` from `source` (default: data_source) and save it
+    as cache data `dfname`. If `incremental`, only new or changed quarters are normalized
+    and merged into the expired cache data.
+    """
+    type="earnings"
+    source = data_source if source is None else source
+    df_old = get_cache(fname=dfname, clear_cache=False) if incremental else None
+    if df_old is not None and len(df_old) == 0:
+        df_old = None
+
+    if df_old is None and not is_valid_ticker(ticker, verbose=verbose, source=source):
         print("invalid ticker name {}".format(ticker))
         return None
     
     verbose and print("getting new {} data".format(type))
-    dct = si.get_earnings_history(ticker)
+    dct = source.earnings_history(ticker)
+    if df_old is not None:
+        if len(dct) == 0: # keep the data we have
+            _save_earnings(ticker, dfname, df_old)
+            return df_old
+        dct = _new_earnings_rows(dct, df_old)
+        verbose and print("{} new or changed quarters of {}".format(len(dct), ticker))
+        if len(dct) == 0:
+            _save_earnings(ticker, dfname, df_old)
+            return df_old
+
     if len(dct) == 0:
         print("no data for {}".format(ticker))
-        save_pickle(dfname=dfname, obj=None)
+        _save_earnings(ticker, dfname, None)
         return None
 
-    df = pd.json_normalize(dct).dropna()
-    if len(df) == 0:
+    with stage("parse_earnings", ticker):
+        df = normalize_earnings({ticker: dct})
+    if len(df) == 0 and df_old is None:
         print("no data for {}".format(ticker))
-        save_pickle(dfname=dfname, obj=None)
+        _save_earnings(ticker, dfname, None)
         return None
 
-    df["startdatetime"] = df["startdatetime"].str.replace(r"T.*$", "", regex=True)
-    df["startdatetime"] = pd.to_datetime(df["startdatetime"], errors='coerce')
+    if df_old is not None: # newest quarters first as Yahoo does
+        df_old = df_old[~df_old["startdatetime"].isin(df["startdatetime"])]
+        df = pd.concat([df, df_old], ignore_index=True)
+        df = df.sort_values("startdatetime", ascending=False, kind="stable").reset_index(drop=True)
 
-    save_pickle(dfname=dfname, obj=df)
+    _save_earnings(ticker, dfname, df)
 
     return df
 
 
-def get_earnings_history(tickers, clear_cache=1, verbose=False):
+def get_earnings_history(tickers, clear_cache=1, columns=None, n_workers=None, incremental=False, verbose=False):
     """gets actual/expected EPS history of tickers
     
     This function gets actual/expected EPS history data from cache data if available.
@@ -205,16 +1515,150 @@ def get_earnings_history(tickers, clear_cache=1, verbose=False):
     Args:
         tickers(list or str): Ticker name(s)
         clear_cache(int): Number of days the cache is valid
+        columns(list): columns to be read (all columns if None)
+        n_workers(int): number of tickers downloaded concurrently
+        incremental(bool): update expired cache data only with new or changed quarters
         verbose(bool): verbose mode
     Returns:
         dataframe of EPS histories
 
+    Downloaded EPS histories of many tickers are normalized together (see `ingest_earnings()`)
+    unless `incremental` or `stale_while_revalidate`.
+
     Usage:
         ticker=["AMZN", "APPL"]
         df_earnings = get_earnings_history(ticker)
         plot_eps(df_earnings)
     """
-    return get_data(fn=_get_earnings_history, tickers=tickers,clear_cache=clear_cache,verbose=verbose)
+    if isinstance(tickers, str):
+        tickers = [tickers]
+    if not incremental and not stale_while_revalidate:
+        if _refresh_earnings(tickers, clear_cache=clear_cache, n_workers=n_workers, verbose=verbose):
+            clear_cache = False # all the expired data are downloaded now
+    return get_data(fn=_get_earnings_history, tickers=tickers, cache_type="earnings", columns=columns,
+                    n_workers=n_workers, clear_cache=clear_cache, incremental=incremental, verbose=verbose)
+
+## EPS feature table
+# Features of each ticker and quarter are computed when EPS history is downloaded
+# and saved as cache data "eps_features" with the time stamp of the EPS history.
+
+def eps_features(df, vol_window=8):
+    """Return features of EPS history `df` (one or more tickers) per ticker and quarter.
+
+    Columns are ticker, startdatetime, epsestimate, epsactual, epssurprisepct, companyshortname and
+        beat: EPS beat the estimate (epssurprisepct >= 0)
+        beat_streak: number of consecutive beats up to the quarter (0 if missed)
+        eps_yoy: growth of epsactual from the same quarter a year before (%, NaN if not reported)
+        surprise_vol: standard deviation of the last `vol_window` reported epssurprisepct
+            (quarters without a surprise are skipped)
+    Rows are sorted by ticker and date. All features are computed in one vectorized pass.
+    """
+    dates = pd.to_datetime(df["startdatetime"])
+    valid = (df["ticker"].notna() & dates.notna()).to_numpy()
+    codes, _ = pd.factorize(df["ticker"].to_numpy()[valid], sort=True)
+    days = dates.to_numpy()[valid].astype("datetime64[D]").astype("int64")
+    order = _last_quarters(codes, days, len(codes) + 1) # all rows by ticker and date
+    codes = codes[order]
+    order = np.flatnonzero(valid)[order]
+    out = df.iloc[order].reindex(columns=["ticker", "startdatetime", "epsestimate", "epsactual", "epssurprisepct",
+                                          "companyshortname"]).reset_index(drop=True)
+    out["startdatetime"] = dates.to_numpy()[order]
+
+    rows = np.arange(len(out))
+    start = np.searchsorted(codes, codes) # first row of the ticker
+    surprise = out["epssurprisepct"].to_numpy(dtype="float64")
+    beat = surprise >= 0
+    # a run of beats starts at the first row of a ticker or after a miss
+    run_start = np.maximum.accumulate(np.where((rows == start) | np.append(False, ~beat[:-1]), rows, 0))
+    actual = out["epsactual"].to_numpy(dtype="float64")
+    # quarter of a row as ticker and quarter number, sorted as the rows
+    months = out["startdatetime"].to_numpy().astype("datetime64[M]").astype("int64")
+    quarter = codes.astype("int64") * 2**32 + months // 3
+    prev = np.searchsorted(quarter, quarter - 4, side="right") - 1 # last row of the quarter a year before
+    found = (prev >= 0) & (quarter[np.maximum(prev, 0)] == quarter - 4)
+    prior = np.where(found, actual[np.maximum(prev, 0)], np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        yoy = (actual - prior) / np.abs(prior) * 100
+    yoy[~np.isfinite(yoy)] = np.nan
+
+    # standard deviation from cumulative sums of the last `vol_window` reported surprises of the ticker
+    reported = ~np.isnan(surprise)
+    x = surprise[reported]
+    s1, s2 = np.concatenate([[0.0], np.cumsum(x)]), np.concatenate([[0.0], np.cumsum(x * x)])
+    n = np.concatenate([[0], np.cumsum(reported)]) # number of reported surprises before a row
+    last = n[rows + 1]
+    first = np.maximum(last - vol_window, n[start])
+    count = last - first
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var = ((s2[last] - s2[first]) - (s1[last] - s1[first]) ** 2 / count) / (count - 1)
+    vol = np.sqrt(np.maximum(var, 0))
+    vol[count < min(4, vol_window)] = np.nan
+
+    out["beat"] = beat
+    out["beat_streak"] = np.where(beat, rows - run_start + 1, 0)
+    out["eps_yoy"] = yoy
+    out["surprise_vol"] = vol
+    return out
+
+def _named_features(df):
+    """Make features of version 6 again with the company name of the cached EPS history"""
+    names = {}
+    for ticker in pd.unique(df["ticker"]):
+        history = get_cache(ticker + "_earnings", clear_cache=False)
+        if history is not None and "companyshortname" in history.columns:
+            history = history.dropna(subset=["companyshortname"]).sort_values("startdatetime", kind="stable")
+            if len(history) != 0:
+                names[ticker] = history["companyshortname"].iloc[-1]
+    return eps_features(df.assign(companyshortname=df["ticker"].map(names)))
+
+_migrations[("eps_features", 6)] = _named_features
+
+def _synced_features(tickers):
+    """Return tickers of which feature tables are made from the current EPS history"""
+    rows = _db().execute("SELECT e.ticker FROM entries e JOIN entries f ON f.ticker = e.ticker "
+                         "AND f.type = 'eps_features' AND f.fetched = e.fetched WHERE e.type = 'earnings'")
+    synced = {row[0] for row in rows}
+    return [ticker for ticker in tickers if ticker in synced]
+
+def _get_eps_features(ticker, clear_cache=1, verbose=False):
+    """Return the feature table of `ticker` made from its EPS history within `clear_cache` days"""
+    dfname = ticker + "_eps_features"
+    df = _get_earnings_history(ticker, clear_cache=clear_cache, verbose=verbose) # saves features if downloaded
+    if len(_synced_features([ticker])) != 0:
+        return get_cache(dfname, clear_cache=False)
+    with cache_lock(dfname): # EPS history saved before feature tables were introduced
+        verbose and print("making features of {}".format(ticker))
+        features = None if df is None or len(df) == 0 else eps_features(df)
+        fetched = cache_stamp(ticker + "_earnings")
+        if fetched is not None:
+            save_cache(dfname, features, fetched=fetched)
+    return features
+
+@profiled("get_eps_features")
+def get_eps_features(tickers, clear_cache=1, columns=None, n_workers=None, verbose=False):
+    """Return EPS feature tables (see `eps_features()`) of `tickers`.
+    Tables of tickers of which EPS history is fresh are read from cache in a single scan,
+    EPS histories of the others are downloaded (updating their tables).
+
+    Usage:
+        df = get_eps_features(tickers)
+        df.groupby("ticker").last()  # current beat streak, EPS growth and surprise volatility
+    """
+    if isinstance(tickers, str):
+        tickers = [tickers]
+    tickers = sorted(ticker.upper() for ticker in tickers)
+    fresh = fresh_caches("earnings", tickers, clear_cache=clear_cache, verbose=verbose)
+    ready = _synced_features([ticker for ticker in tickers if ticker in fresh])
+    rest = sorted(set(tickers) - set(ready))
+
+    frames = [get_data(fn=_no_fetch, tickers=ready, cache_type="eps_features", columns=columns, clear_cache=False),
+              get_data(fn=_get_eps_features, tickers=rest, columns=columns, n_workers=n_workers,
+                       clear_cache=clear_cache, verbose=verbose)]
+    frames = [df for df in frames if len(df) != 0]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    return df.sort_values(by="ticker", kind="stable", ignore_index=True)
 
 def _plot_fig(df, ax, target, title="", ylabel="", xticklabels=True, axhline=None):
     """
@@ -235,8 +1679,9 @@ def _plot_fig(df, ax, target, title="", ylabel="", xticklabels=True, axhline=Non
         ax.set_xticklabels([])
 #    ax.xaxis.set_major_locator(plt.MaxNLocator(len(df)))
 
+@profiled("plot_eps_history")
 def plot_eps_history(tickers, clear_cache=1, last=20, largefig=False, verbose=False):
-    df=get_earnings_history(tickers, clear_cache=clear_cache, verbose=verbose)
+    df=get_eps_features(tickers, clear_cache=clear_cache, verbose=verbose)
     tickers = df.ticker.unique()
     n_tick = len(tickers)
 
@@ -271,32 +1716,205 @@ def plot_eps_history(tickers, clear_cache=1, last=20, largefig=False, verbose=Fa
         df_ticker = df[df["ticker"] == ticker].set_index("startdatetime").sort_index()
         df_ticker=df_ticker.tail(min(last, len(df_ticker)))
 
-        _plot_fig(df_ticker, ax, target =["epsactual", "epsestimate"],
-        title=df_ticker["ticker"][0],ylabel="EPS")
+        with stage("plot_eps_history.draw", ticker):
+            _plot_fig(df_ticker, ax, target =["epsactual", "epsestimate"],
+            title=df_ticker["ticker"][0],ylabel="EPS")
 
-    fig.tight_layout()
-    plt.show()
+    with stage("plot_eps_history.layout"):
+        fig.tight_layout()
+        plt.show()
     return(df)
 
+# numbers in Yahoo Finance such as "2.1T", "35.4%", "$1,234" and "-0.5"
+_number_re = re.compile(r"^\s*\$?(?P<num>[-+]?[\d,]*\.?\d+(?:[eE][-+]?\d+)?)\s*(?P<unit>[kKMBT%]?)\s*$")
+_number_units = {"": 1, "%": 1, "k": 1e3, "K": 1e3, "M": 1e6, "B": 1e9, "T": 1e12}
+
+def parse_number(values):
+    """Convert values of Yahoo Finance such as "2.1T", "35.4%" or "$1,234" into float64.
+
+    Percentages are kept in percent (e.g. "35.4%" -> 35.4).
+    Values which are not numbers (e.g. dates) are NaN.
+    """
+    values = pd.Series(values)
+    parts = values.astype(str).str.extract(_number_re)
+    num = pd.to_numeric(parts["num"].str.replace(",", "", regex=False), errors="coerce")
+    return (num * parts["unit"].map(_number_units)).astype("float64").set_axis(values.index)
+
+_migrations[("valuation", 2)] = lambda df: df.assign(number=parse_number(df["values"]))
+
+# schema of valuation data: (stable key, label of Yahoo Finance without footnote numbers/dates, dtype)
+valuation_schema = [
+    # si.get_quote_table()
+    ("TARGET", "1y Target Est", "float64"),
+    ("RANGE_52W", "52 Week Range", "string"),
+    ("ASK", "Ask", "string"),
+    ("AVG_VOLUME", "Avg. Volume", "float64"),
+    ("BETA", "Beta (5Y Monthly)", "float64"),
+    ("BID", "Bid", "string"),
+    ("DAY_RANGE", "Day's Range", "string"),
+    ("EPS", "EPS (TTM)", "float64"),
+    ("EARNINGS_DATE", "Earnings Date", "string"),
+    ("EX_DIVIDEND_DATE", "Ex-Dividend Date", "string"),
+    ("DIVIDEND", "Forward Dividend & Yield", "string"),
+    ("CAP", "Market Cap", "float64"),
+    ("OPEN", "Open", "float64"),
+    ("PER", "PE Ratio (TTM)", "float64"),
+    ("PRICE", "Previous Close", "float64"),
+    ("QUOTE", "Quote Price", "float64"),
+    ("VOLUME", "Volume", "float64"),
+    # si.get_stats()
+    ("CHANGE_52W", "52-Week Change", "float64"),
+    ("SP500_CHANGE_52W", "S&P500 52-Week Change", "float64"),
+    ("HIGH_52W", "52 Week High", "float64"),
+    ("LOW_52W", "52 Week Low", "float64"),
+    ("MA50", "50-Day Moving Average", "float64"),
+    ("MA200", "200-Day Moving Average", "float64"),
+    ("AVG_VOLUME_3M", "Avg Vol (3 month)", "float64"),
+    ("AVG_VOLUME_10D", "Avg Vol (10 day)", "float64"),
+    ("SHARES", "Shares Outstanding", "float64"),
+    ("IMPLIED_SHARES", "Implied Shares Outstanding", "float64"),
+    ("FLOAT", "Float", "float64"),
+    ("INSIDERS", "% Held by Insiders", "float64"),
+    ("INSTITUTIONS", "% Held by Institutions", "float64"),
+    ("SHARES_SHORT", "Shares Short", "float64"),
+    ("SHORT_RATIO", "Short Ratio", "float64"),
+    ("SHORT_FLOAT", "Short % of Float", "float64"),
+    ("SHORT_SHARES", "Short % of Shares Outstanding", "float64"),
+    ("SHARES_SHORT_PRIOR", "Shares Short (prior month)", "float64"),
+    ("FWD_DIVIDEND_RATE", "Forward Annual Dividend Rate", "float64"),
+    ("FWD_DIVIDEND_YIELD", "Forward Annual Dividend Yield", "float64"),
+    ("TTM_DIVIDEND_RATE", "Trailing Annual Dividend Rate", "float64"),
+    ("TTM_DIVIDEND_YIELD", "Trailing Annual Dividend Yield", "float64"),
+    ("DIVIDEND_YIELD_5Y", "5 Year Average Dividend Yield", "float64"),
+    ("PAYOUT", "Payout Ratio", "float64"),
+    ("DIVIDEND_DATE", "Dividend Date", "string"),
+    ("SPLIT_FACTOR", "Last Split Factor", "string"),
+    ("SPLIT_DATE", "Last Split Date", "string"),
+    ("FISCAL_YEAR_END", "Fiscal Year Ends", "string"),
+    ("MRQ", "Most Recent Quarter (mrq)", "string"),
+    ("PM", "Profit Margin", "float64"),
+    ("OM", "Operating Margin (ttm)", "float64"),
+    ("ROA", "Return on Assets (ttm)", "float64"),
+    ("ROE", "Return on Equity (ttm)", "float64"),
+    ("REVENUE", "Revenue (ttm)", "float64"),
+    ("REVENUE_PS", "Revenue Per Share (ttm)", "float64"),
+    ("QRG", "Quarterly Revenue Growth (yoy)", "float64"),
+    ("GROSS_PROFIT", "Gross Profit (ttm)", "float64"),
+    ("EBITDA", "EBITDA", "float64"),
+    ("NET_INCOME", "Net Income Avi to Common (ttm)", "float64"),
+    ("DILUTED_EPS", "Diluted EPS (ttm)", "float64"),
+    ("QEG", "Quarterly Earnings Growth (yoy)", "float64"),
+    ("CASH", "Total Cash (mrq)", "float64"),
+    ("CASH_PS", "Total Cash Per Share (mrq)", "float64"),
+    ("DEBT", "Total Debt (mrq)", "float64"),
+    ("DEBT_EQUITY", "Total Debt/Equity (mrq)", "float64"),
+    ("CURRENT_RATIO", "Current Ratio (mrq)", "float64"),
+    ("BVPS", "Book Value Per Share (mrq)", "float64"),
+    ("OCF", "Operating Cash Flow (ttm)", "float64"),
+    ("LFCF", "Levered Free Cash Flow (ttm)", "float64"),
+    # si.get_stats_valuation()
+    ("CAP_INTRADAY", "Market Cap (intraday)", "float64"),
+    ("EV", "Enterprise Value", "float64"),
+    ("TRAILING_PE", "Trailing P/E", "float64"),
+    ("FORWARD_PE", "Forward P/E", "float64"),
+    ("PEG", "PEG Ratio (5 yr expected)", "float64"),
+    ("PSR", "Price/Sales (ttm)", "float64"),
+    ("PBR", "Price/Book (mrq)", "float64"),
+    ("EV_REVENUE", "Enterprise Value/Revenue", "float64"),
+    ("EV_EBITDA", "Enterprise Value/EBITDA", "float64"),
+]
+valuation_labels = {key: label for key, label, _ in valuation_schema}
+valuation_numeric = [key for key, _, dtype in valuation_schema if dtype == "float64"]
+valuation_text = [key for key, _, dtype in valuation_schema if dtype == "string"]
+_label_keys = {label: key for key, label, _ in valuation_schema}
+_unknown_labels = set()
+
+# e.g. 'Shares Short (Jul 29, 2021) 4', 'Shares Short (prior month Jun 29, 2021) 4', '52 Week High 3'
+_date_label_re = re.compile(r"\s*\([A-Z][a-z]{2} \d{1,2}, \d{4}\)")
+_prior_date_label_re = re.compile(r"(?<=prior month) [A-Z][a-z]{2} \d{1,2}, \d{4}")
+_footnote_label_re = re.compile(r"\s+\d+$")
+
+def normalize_label(label):
+    """Remove dates and footnote numbers from a label of Yahoo Finance
+    (e.g. 'Shares Short (Jul 29, 2021) 4' -> 'Shares Short')"""
+    label = _date_label_re.sub("", label)
+    label = _prior_date_label_re.sub("", label)
+    return _footnote_label_re.sub("", label).strip()
+
+def metric_key(label):
+    """Return the stable key of a Yahoo Finance label in `valuation_schema`.
+    Unknown labels are reported once and kept as the normalized label.
+    """
+    normalized = normalize_label(label)
+    key = _label_keys.get(normalized)
+    if key is None:
+        if normalized not in _unknown_labels:
+            _unknown_labels.add(normalized)
+            print("unknown valuation label '{}' is kept as '{}'".format(label, normalized))
+        return normalized
+    return key
+
+def _valuation_row(df, ticker):
+    """Convert valuation data of `ticker` in (info, values, number) rows into a one-row dataframe
+    of which columns are the keys of `valuation_schema` (see `metric_key()`).
+    Columns of `valuation_numeric` are float64 and those of `valuation_text` are string.
+    Unknown labels are always string because their values can be numbers for a ticker
+    and text (e.g. "N/A") for another, and a column must have one type in all cache files.
+    """
+    df = df.assign(info=df["info"].map(metric_key)).drop_duplicates("info", keep="last").set_index("info")
+    extra = [key for key in df.index if key not in valuation_labels]
+    text = valuation_text + extra
+
+    row = pd.DataFrame({"ticker": pd.Series([ticker], dtype="string")})
+    row[valuation_numeric] = df["number"].reindex(valuation_numeric).to_numpy(dtype="float64").reshape(1, -1)
+    values = df["values"].reindex(text)
+    for key in text:
+        row[key] = pd.Series([None if pd.isna(values[key]) else str(values[key])], dtype="string")
+    return row
+
+def _rekey_valuation(df):
+    """Convert a valuation row of which columns are labels of Yahoo Finance (version 4).
+    Columns which are already keys (data of version 3 converted by `_valuation_row()`) are kept.
+    """
+    row = df.drop(columns="ticker").iloc[0]
+    labels = [valuation_labels.get(col, col) for col in row.index]
+    rows = pd.DataFrame({"info": labels, "values": row.to_numpy(dtype=object)})
+    rows["number"] = parse_number(rows["values"])
+    return _valuation_row(rows, df["ticker"].iloc[0])
+
+_migrations[("valuation", 3)] = lambda df: _valuation_row(df, df["ticker"].iloc[0])
+def _stringify_extra(df):
+    """Convert columns of unknown labels into string (version 5 typed them by their values)"""
+    return df.astype({col: "string" for col in df.columns if col != "ticker" and col not in valuation_labels})
+
+_migrations[("valuation", 4)] = _rekey_valuation
+_migrations[("valuation", 5)] = _stringify_extra
+
 def _get_valuation(ticker, clear_cache=7, verbose=False):
     """Get valuation data of a `ticker` (str)
 
     See `get_valuation()` for more detail.
     """
     dfname = ticker + "_valuation"
-    df = get_cache(fname=dfname, clear_cache=clear_cache, verbose=verbose)
-    if df is not None: # True if data file exists (df is empty if no data is available)
-        return(df)
-    
-    if not check_ticker(ticker):
-        print("invalid ticker name".format(ticker))
+    return _get_or_fetch(dfname, lambda: _fetch_valuation(ticker, dfname, verbose=verbose),
+                         clear_cache=clear_cache, verbose=verbose)
+
+def _fetch_valuation(ticker, dfname, verbose=False):
+    """Download valuation data of `ticker` and save it as cache data `dfname`"""
+    if not is_valid_ticker(ticker, verbose=verbose):
+        print("invalid ticker name {}".format(ticker))
         return None    
         
-    verbose and print("getting new quote table")
-    dct_qt = si.get_quote_table(ticker)
+    verbose and print("getting new quote table and stats")
+    # the three requests are independent
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(_retry, fn, ticker)
+                   for fn in [data_source.quote_table, data_source.stats, data_source.stats_valuation]]
+        dct_qt, df_st, df_val = [future.result() for future in futures]
+
     if len(dct_qt) == 0:
         print("no quote_table data for {}".format(ticker))
-        save_pickle(dfname=dfname, obj=None)
+        save_cache(dfname=dfname, obj=None)
         return None    
     
     df_qt = (
@@ -306,23 +1924,30 @@ def _get_valuation(ticker, clear_cache=7, verbose=False):
         .set_axis(["info", "values"], axis=1)
     )
 
-    df_st = si.get_stats(ticker).set_axis(["info", "values"], axis=1)
+    df_st = df_st.set_axis(["info", "values"], axis=1)
     df_st = df_st[df_st["info"] != 'Beta (5Y Monthly)']
-    df_val = si.get_stats_valuation(ticker).set_axis(["info", "values"], axis=1)
+    df_val = df_val.set_axis(["info", "values"], axis=1)
     if len(df_st) == 0 or len(df_val) == 0:
         print("no stats data for {}".format(ticker))
-        save_pickle(dfname=df_val, obj=None)
+        save_cache(dfname=dfname, obj=None)
         return None 
     
-    df = pd.concat([df_qt, df_st, df_val], ignore_index=True).sort_values(by="info")
-    df["ticker"] = ticker
+    with stage("parse_valuation", ticker):
+        df = pd.concat([df_qt, df_st, df_val], ignore_index=True)
+        df["number"] = parse_number(df["values"])
+        df = _valuation_row(df, ticker)
 
-    save_pickle(dfname=dfname, obj=df)
+    save_cache(dfname=dfname, obj=df)
+    save_snapshot("valuation", ticker, df)
 
     return df
 
-def get_valuation(tickers, clear_cache=7, verbose=False):
-    """Get statistics data of a ticker and return a dataframe
+def get_valuation(tickers, clear_cache=7, n_workers=None, verbose=False):
+    """Get statistics data of a ticker and return a dataframe indexed by tickers
+    Columns are the stable keys of `valuation_schema` (e.g. "PSR" for "Price/Sales (ttm)",
+    see `valuation_labels`). Numbers (e.g. "2.1T", "35.4%") are parsed into float64 at
+    download (`parse_number()`) and the other values (e.g. dates) are strings.
+    Values of labels not in `valuation_schema` are kept as strings.
 
     This function calls 
         - si.get_quote_table()
@@ -362,12 +1987,177 @@ def get_valuation(tickers, clear_cache=7, verbose=False):
             - si.get_stats_valuation() returns histories of Market Cap, Enterprise Value and Trailing P/E
             - Did the return value change?
     and combine the results.
+    `n_workers` tickers are downloaded concurrently.
     """
-    df = get_data(fn=_get_valuation,tickers=tickers,clear_cache=clear_cache,verbose=verbose)
-    tmp=df.info
-    df = df.pivot(index="ticker", columns="info", values="values")
+    df = get_data(fn=_get_valuation,tickers=tickers,cache_type="valuation",n_workers=n_workers,
+                  clear_cache=clear_cache,verbose=verbose)
+    if len(df) != 0:
+        df = df.set_index("ticker")
     return df
 
+## daily snapshot history
+# Each download of valuation data is also kept as a snapshot of the day:
+#   cache/history/<type>/<YYYY-MM-DD>/<TICKER>.pkl  snapshots of today (the last one of a day is kept)
+#   cache/history/<type>/<YYYY-MM-DD>.parquet       snapshots of a past day of this month
+#   cache/history/<type>/<YYYY-MM>.parquet          snapshots of a past month
+# Past days and months are merged by compact_history() so that histories of many tickers
+# over a year are read by a range scan of a dozen files.
+
+def history_path(type, partition, ticker=None, format=None):
+    """Return the snapshot file of `ticker` on date `partition` (YYYY-MM-DD, always a small pickle),
+    or the merged file of `partition` (YYYY-MM-DD or YYYY-MM) if ticker is None"""
+    if ticker is None:
+        ext = "parquet" if (format or cache_format) == "parquet" else "pkl"
+        return "{}/history/{}/{}.{}".format(cache_dir, type, partition, ext)
+    return "{}/history/{}/{}/{}.pkl".format(cache_dir, type, partition, ticker)
+
+def _write_snapshot(fname, df):
+    if fname.endswith(".parquet"):
+        _write_parquet(fname, df)
+    else:
+        save_pickle(os.path.basename(fname)[:-len(".pkl")], df, data_dir=os.path.dirname(fname))
+
+def _read_snapshot(fname):
+    if fname.endswith(".parquet"):
+        return pq.read_table(fname, memory_map=True).to_pandas()
+    return load_pickle(os.path.basename(fname)[:-len(".pkl")], data_dir=os.path.dirname(fname))
+
+def save_snapshot(type, ticker, df, fetched=None):
+    """Save data `df` of `ticker` downloaded at `fetched` (unix time, default: now)
+    as the snapshot of the day in the history of `type`.
+    Columns "date" (YYYY-MM-DD) and "fetched" are added.
+    """
+    if df is None or len(df) == 0:
+        return
+    fetched = time.time() if fetched is None else fetched
+    date = datetime.fromtimestamp(fetched).strftime("%Y-%m-%d")
+    df = df.copy()
+    df.insert(0, "date", date)
+    df.insert(1, "fetched", fetched)
+    fname = history_path(type, date, ticker)
+    _write_snapshot(fname, df)
+    legacy = fname[:-len(".pkl")] + ".parquet" # saved by older versions
+    if os.path.exists(legacy):
+        os.remove(legacy)
+
+def _history_files(type):
+    """Return {partition: (merged file or None, snapshot files of the day)} of the history of `type`"""
+    history_dir = Path(cache_dir, "history", type)
+    ext = ".parquet" if cache_format == "parquet" else ".pkl"
+    files = {}
+    if not history_dir.is_dir():
+        return files
+    for path in history_dir.iterdir():
+        if path.is_dir(): # snapshots of older versions can be parquet files
+            snapshots = sorted(str(fname) for fname in path.iterdir() if fname.suffix in (".pkl", ".parquet"))
+            files[path.name] = (files.get(path.name, (None, []))[0], snapshots)
+        elif path.name.endswith(ext):
+            partition = path.name[:-len(ext)]
+            files[partition] = (str(path), files.get(partition, (None, []))[1])
+    return dict(sorted(files.items()))
+
+def _merge_snapshots(fname, fnames):
+    """Merge snapshot files `fnames` into `fname` (later snapshots of a ticker and date win)"""
+    frames = [_read_snapshot(f) for f in ([fname] if os.path.isfile(fname) else []) + fnames]
+    frames = [df for df in frames if len(df) != 0]
+    if len(frames) != 0:
+        df = pd.concat(frames, ignore_index=True)
+        df = df.drop_duplicates(["date", "ticker"], keep="last").sort_values(["date", "ticker"], ignore_index=True)
+        _write_snapshot(fname, df)
+    for f in fnames:
+        os.remove(f)
+
+def compact_history(type="valuation", verbose=False):
+    """Merge snapshots of each past day into one file of the day
+    and files of the days of each past month into one file of the month"""
+    now = today()
+    with cache_lock("history_" + type):
+        for partition, (merged, snapshots) in _history_files(type).items():
+            if len(snapshots) != 0 and partition < now:
+                verbose and print("merging snapshots of {} on {}".format(type, partition))
+                _merge_snapshots(history_path(type, partition), snapshots)
+        for partition, (merged, snapshots) in _history_files(type).items():
+            day_dir = os.path.dirname(history_path(type, partition, "_"))
+            if len(snapshots) == 0 and os.path.isdir(day_dir) and partition < now:
+                os.rmdir(day_dir)
+
+        days = {}
+        for partition, (merged, _) in _history_files(type).items():
+            if len(partition) == len("YYYY-MM-DD") and merged is not None and partition[:7] < now[:7]:
+                days.setdefault(partition[:7], []).append(merged)
+        for month, fnames in days.items():
+            verbose and print("merging snapshots of {} in {}".format(type, month))
+            _merge_snapshots(history_path(type, month), fnames)
+
+@profiled("get_history")
+def get_history(type="valuation", tickers=None, columns=None, start=None, end=None, verbose=False):
+    """Return snapshots of `type` from `start` to `end` in a range scan.
+
+    Args:
+        tickers(list): ticker names. All tickers if None.
+        columns(list): columns to be read (all columns if None). "date" and "ticker" are always read.
+        start, end(str or datetime): first and last dates (e.g. "2021-08-01"). No limit if None.
+    Returns:
+        dataframe of snapshots (one row per ticker and date) sorted by date and ticker.
+        "date" is datetime and "fetched" is the unix time of the download.
+    """
+    compact_history(type, verbose=verbose)
+    start = None if start is None else pd.Timestamp(start).strftime("%Y-%m-%d")
+    end = None if end is None else pd.Timestamp(end).strftime("%Y-%m-%d")
+
+    fnames = []
+    for partition, (merged, snapshots) in _history_files(type).items():
+        if (start is None or partition >= start[:len(partition)]) and (end is None or partition <= end[:len(partition)]):
+            fnames += ([] if merged is None else [merged]) + snapshots
+    fnames = [os.path.abspath(fname) for fname in fnames]
+    if tickers is not None:
+        tickers = [ticker.upper() for ticker in ([tickers] if isinstance(tickers, str) else tickers)]
+    if columns is not None:
+        columns = ["date", "ticker"] + [col for col in columns if col not in ("date", "ticker")]
+
+    verbose and print("scanning {} snapshot files of {}".format(len(fnames), type))
+    frames = []
+    scan = [fname for fname in fnames if fname.endswith(".parquet")] # merged files
+    if len(scan) != 0:
+        filter = None
+        for expr in [None if tickers is None else ds.field("ticker").isin(tickers),
+                     None if start is None else ds.field("date") >= start,
+                     None if end is None else ds.field("date") <= end]:
+            if expr is not None:
+                filter = expr if filter is None else filter & expr
+        frames.append(_scan_parquet(scan, columns=columns, filter=filter))
+    frames += [_read_snapshot(fname) for fname in fnames if not fname.endswith(".parquet")]
+    frames = [df for df in frames if len(df) != 0]
+    df = pd.concat(frames, ignore_index=True) if len(frames) != 0 else pd.DataFrame()
+    if len(df) != 0: # rows of the snapshots of today
+        rows = pd.Series(True, index=df.index)
+        if tickers is not None:
+            rows &= df["ticker"].isin(tickers)
+        if start is not None:
+            rows &= df["date"] >= start
+        if end is not None:
+            rows &= df["date"] <= end
+        df = df[rows]
+        if columns is not None:
+            df = df[[col for col in columns if col in df.columns]]
+    if len(df) == 0:
+        return pd.DataFrame()
+
+    df["date"] = pd.to_datetime(df["date"])
+    return df.sort_values(["date", "ticker"], ignore_index=True)
+
+def valuation_history(tickers=None, key="PSR", start=None, end=None, verbose=False):
+    """Return the history of valuation metric `key` (e.g. "PSR", "CAP", "PER")
+    as a dataframe of dates x tickers made from daily snapshots (nothing is downloaded).
+
+    Usage:
+        valuation_history(tickers, "PSR", start=datetime.today() - timedelta(days=365))
+    """
+    df = get_history("valuation", tickers=tickers, columns=[key], start=start, end=end, verbose=verbose)
+    if len(df) == 0 or key not in df.columns:
+        return pd.DataFrame()
+    return df.pivot(index="date", columns="ticker", values=key)
+
 # def get_valuation_data(tickers, clear_cache=7, verbose=False):
 #     if isinstance(tickers, str):
 #         tickers = [tickers]
@@ -386,47 +2176,39 @@ def get_valuation(tickers, clear_cache=7, verbose=False):
 def col_name(df, str):
     return [col for col in df.columns if str in col]
 
+@profiled("show_valuation")
 def show_valuation(tickers, clear_cache=7, hist=True, table=True, key="PSR", ascending=False, verbose=False):
     """Return PSR sorted list. """
     key=key.upper()
 
     df = get_valuation(tickers, clear_cache=clear_cache, verbose=verbose)
-    
-    PSR = col_name(df, "Price/Sales")
-    PBR = col_name(df, "Price/Book")
-    PER = col_name(df, "PE Ratio")
-    EPS = col_name(df, "EPS (TTM)")
-    Target = col_name(df, "Target")
-    Cap = ["Market Cap"]
-    Date = col_name(df, "Earnings Date")
-    Dividend = col_name(df, "Forward Dividend")
-    Price = col_name(df, "Close")
-
-    PM = col_name(df, "Profit Margin")
-    QEG= col_name(df, "Quarterly Earnings Growth (yoy)")
-    QRG= col_name(df, "Quarterly Revenue Growth (yoy)")
-    ROE = col_name(df, "Return on Equity (ttm)")
-    OM= col_name(df, "Operating Margin (ttm)")
-    OCF= col_name(df, "Operating Cash Flow (ttm)")
-    Revenue = col_name(df, "Revenue (ttm)")
-    NShares = (df,'Shares Outstanding 5')
-    OCFM=["Operating Cash Flow Margin(ttm)"]
+    df["OCFM"]=df["OCF"]/df["REVENUE"]
+    # show labels of Yahoo Finance
+    labels = dict(valuation_labels, OCFM="Operating Cash Flow Margin(ttm)")
+    df = df.rename(columns=labels)
+
+    PSR = [labels["PSR"]]
+    PBR = [labels["PBR"]]
+    PER = [labels["PER"]]
+    EPS = [labels["EPS"]]
+    Target = [labels["TARGET"]]
+    Cap = [labels["CAP"]]
+    Date = [labels["EARNINGS_DATE"]]
+    Dividend = [labels["DIVIDEND"]]
+    Price = [labels["PRICE"]]
+
+    PM = [labels["PM"]]
+    QEG= [labels["QEG"]]
+    QRG= [labels["QRG"]]
+    ROE = [labels["ROE"]]
+    OM= [labels["OM"]]
+    OCF= [labels["OCF"]]
+    Revenue = [labels["REVENUE"]]
+    NShares = [labels["SHARES"]]
+    OCFM=[labels["OCFM"]]
   
-
     key_dct={"PSR":PSR,"PBR":PBR,"PER":PER,"EPS":EPS,"CAP":Cap,"QEG":QEG,"QRG":QRG,"ROE":ROE}
 
-    num_dct={"T":12,"B":9,"M":6,"k":3}
-    #    col= [Cap,PM,QEG,QRG,OM,OCF,Revenue]
-    for col in [Cap,PM,QEG,QRG,OM,OCF,ROE,Revenue]:
-        for i in num_dct:
-           df[col] = df[col].apply(lambda x: x.str.replace(r"{}$".format(i), "e{}".format(num_dct[i]), regex=True))
-        df[col] = df[col].apply(lambda x: x.str.replace(r"[,\%$]", "", regex=True))
-
-#    numeric = Cap + Price + Target + PSR + PER + PBR + PM + QEG + QRG + QM
-    numeric = Cap + Price + Target + PSR + PER + PBR + QRG + PM + ROE + OM + OCF + Revenue
-    df[numeric] = df[numeric].astype("float")
-    df[OCFM[0]]=df[OCF[0]]/df[Revenue[0]]
-
     if hist:
         defaultPlotting()
         ax = sns.histplot(data=df[key_dct[key]], bins=20).set_title(
@@ -496,7 +2278,8 @@ def show_valuation(tickers, clear_cache=7, hist=True, table=True, key="PSR", asc
                # .bar(subset=OCFM, align='left', vmin=0, vmax=.6, color=['#3c76af'])\
 
 
-    df_result = df_styler(df_tgt)
+    with stage("show_valuation.style"):
+        df_result = df_styler(df_tgt)
     #html=df_result.render()
     # html=df_result.to_html() # pandas >= 1.3.0
     # import dataframe_image as dfi
@@ -620,6 +2403,113 @@ def show_valuation(tickers, clear_cache=7, hist=True, table=True, key="PSR", asc
 #     plt.show()
 #     return(dct)
 
+def _last_quarters(codes, days, last):
+    """Return positions of the rows within the last `last` days of each group in `codes`
+    (integer codes from 0) in the order of groups and days"""
+    if len(codes) == 0:
+        return np.arange(0)
+    days = days - days.min()
+    order = np.argsort(codes * (days.max() + 1) + days, kind="stable") # sort by group and day
+    counts = np.bincount(codes)
+    ends = np.cumsum(counts)
+    from_end = ends[codes[order]] - 1 - np.arange(len(order))
+    return order[from_end < last]
+
+def beat_counts(df, last=20):
+    """Count EPS beats of each ticker within the last `last` quarters in one pass.
+
+    Tickers are coded as integers and beats and quarters are counted by np.bincount,
+    so that earnings tables of hundreds of thousands of rows are processed at once.
+
+    Args:
+        df: EPS history (see `get_earnings_history()`) or EPS features (see `get_eps_features()`)
+        last(int): number of quarters to be considered
+    Returns:
+        dataframe indexed by ticker and company name with "beat ratio" (%), "beat" and "count"
+    """
+    dates = pd.to_datetime(df["startdatetime"])
+    valid = (df["ticker"].notna() & dates.notna() & df["epssurprisepct"].notna()
+             & df["companyshortname"].notna()).to_numpy()
+    codes, uniques = pd.factorize(df["ticker"].to_numpy()[valid])
+    days = dates.to_numpy()[valid].astype("datetime64[D]").astype("int64")
+    rows = _last_quarters(codes, days, last)
+
+    codes = codes[rows]
+    if "beat" in df.columns: # feature table
+        beat = df["beat"].to_numpy(dtype=bool)[valid][rows]
+    else:
+        beat = df["epssurprisepct"].to_numpy(dtype="float64")[valid][rows] >= 0
+    count = np.bincount(codes, minlength=len(uniques))
+    n_beat = np.bincount(codes, weights=beat, minlength=len(uniques)).astype("int64")
+    names = np.empty(len(uniques), dtype=object) # company name of the last quarter
+    names[codes] = df["companyshortname"].to_numpy()[valid][rows]
+
+    index = pd.MultiIndex.from_arrays([uniques, names], names=["ticker", "companyshortname"])
+    return pd.DataFrame({"beat ratio": n_beat / np.maximum(count, 1) * 100, "beat": n_beat, "count": count},
+                        index=index)[count > 0]
+
+def _rolling_eps(df, window=20, min_qtrs=1):
+    """Return (beat ratio (%), mean surprise (%), number of quarters) of the last `window`
+    quarters of each ticker at each quarter as ticker x quarter arrays, and tickers and quarters"""
+    dates = pd.to_datetime(df["startdatetime"])
+    valid = (df["ticker"].notna() & dates.notna() & df["epssurprisepct"].notna()).to_numpy()
+    codes, tickers = pd.factorize(df["ticker"].to_numpy()[valid], sort=True)
+    if len(codes) == 0:
+        empty = np.empty((0, 0))
+        return empty, empty, empty, pd.Index([], name="ticker"), pd.PeriodIndex([], freq="Q", name="quarter")
+    days = dates.to_numpy()[valid].astype("datetime64[D]").astype("int64")
+    order = _last_quarters(codes, days, len(codes) + 1) # all rows by ticker and day
+    codes = codes[order]
+    surprise = df["epssurprisepct"].to_numpy(dtype="float64")[valid][order]
+    quarters = pd.PeriodIndex(dates[valid].iloc[order], freq="Q").asi8
+
+    # sums over the last `window` rows of the ticker from cumulative sums
+    n = len(codes)
+    start = np.searchsorted(codes, codes) # first row of the ticker
+    first = np.maximum(np.arange(1, n + 1) - window, start)
+    beat_sum = np.concatenate([[0], np.cumsum(surprise >= 0)])
+    surprise_sum = np.concatenate([[0.0], np.cumsum(surprise)])
+    count = np.arange(1, n + 1) - first
+    beat = beat_sum[1:] - beat_sum[first]
+    mean = (surprise_sum[1:] - surprise_sum[first]) / count
+
+    # the last report of a quarter is the value of the quarter and it holds until the next report
+    last = np.append((codes[1:] != codes[:-1]) | (quarters[1:] != quarters[:-1]), True)
+    q0 = quarters.min()
+    shape = (len(tickers), quarters.max() - q0 + 1)
+    matrices = []
+    for values in [beat / count * 100, mean, count]:
+        matrix = np.full(shape, np.nan)
+        matrix[codes[last], quarters[last] - q0] = values[last]
+        matrices.append(pd.DataFrame(matrix).ffill(axis=1).to_numpy())
+    ratio, mean, count = matrices
+    ratio[count < min_qtrs] = np.nan
+    mean[count < min_qtrs] = np.nan
+    columns = pd.period_range(pd.Period("1970Q1", freq="Q") + int(q0), periods=shape[1], freq="Q", name="quarter")
+    return ratio, mean, count, pd.Index(tickers, name="ticker"), columns
+
+def rolling_beat_ratio(df, window=20, min_qtrs=1):
+    """Return EPS beat ratio (%) of the last `window` quarters of every ticker at every quarter
+    as a dataframe of tickers x quarters computed in one vectorized pass.
+    A quarter without a report keeps the value of the last report.
+    Values with less than `min_qtrs` quarters are NaN.
+
+    Usage:
+        df = get_earnings_history(tickers)
+        ratio = rolling_beat_ratio(df, window=8, min_qtrs=8)
+        ratio[ratio.iloc[:, -8:].min(axis=1) >= 75]  # beat ratio >= 75% during the last two years
+        ratio.loc[["AAPL", "MSFT"]].T.plot()
+    """
+    ratio, _, _, tickers, quarters = _rolling_eps(df, window=window, min_qtrs=min_qtrs)
+    return pd.DataFrame(ratio, index=tickers, columns=quarters)
+
+def rolling_surprise(df, window=20, min_qtrs=1):
+    """Return mean EPS surprise (%) of the last `window` quarters of every ticker at every quarter
+    as a dataframe of tickers x quarters (see `rolling_beat_ratio()`)"""
+    _, mean, _, tickers, quarters = _rolling_eps(df, window=window, min_qtrs=min_qtrs)
+    return pd.DataFrame(mean, index=tickers, columns=quarters)
+
+@profiled("beat_ratio")
 def _show_beat_ratio(
     df, last=20, threshold=False, min_qtrs=1, verbose=False
 ):
@@ -631,36 +2521,11 @@ def _show_beat_ratio(
         threshold=80 the threshold of EPS beat ratio to be shown
 
     Examples:
-        df_eps=get_earnings_history(ticker)
-        show_beat_ratio(df_eps)
-    """
-    group = ["ticker", "companyshortname"]
-    target = (
-        df[["startdatetime", "ticker", "epssurprisepct", "companyshortname"]]
-        .dropna()
-        .set_index("startdatetime")
-        .sort_index()
-        .groupby(group)
-        .tail(last)
-    )
-    target["beat"] = target["epssurprisepct"] >= 0
-    if verbose: display(target)
-        
-    ratio = target.groupby(group).mean().rename(columns={"beat": "beat ratio"})
-    count = (
-        target.groupby(group)
-        .count()
-        .drop("epssurprisepct", axis=1)
-        .rename(columns={"beat": "count"})
-    )
-    if verbose: display(count)
-    
-    beat = target.groupby(group).sum().drop("epssurprisepct", axis=1)
-
-    result = ratio.join(count)
-    result = result.join(beat).sort_values(by="beat ratio", ascending=False)
-    result["beat ratio"] = result["beat ratio"] * 100
-    if verbose: display(target)
+        df_eps=get_eps_features(ticker) # or get_earnings_history(ticker)
+        _show_beat_ratio(df_eps)
+    """
+    result = beat_counts(df, last=last).sort_values(by="beat ratio", ascending=False, kind="stable")
+    if verbose: display(result)
     
     if threshold == False:
         print("EPS beat ratio (%) within last {} quarters ({})".format(last, today()))
@@ -676,30 +2541,259 @@ def _show_beat_ratio(
     return result[["beat ratio", "beat", "count"]]
 
 
-def show_beat_ratio(tickers, last=20, threshold=80, min_qtrs=4, clear_cache=False, verbose=False):
+@profiled("show_beat_ratio")
+def show_beat_ratio(tickers, last=20, threshold=80, min_qtrs=4, clear_cache=False, n_workers=None, verbose=False):
     """Search tickers of which EPS beat ratio is larger than a threshold
 
     Args:
         - last: number of quarters to be considred
         - min_qtrs: number of quarters required for evaluation
         - threshold: minimum EPS beat ratio in `last` quarters
+        - n_workers: number of tickers downloaded concurrently
+    See `search_beat_ratio()` to see the best tickers while downloading.
     """
-    n_tick = len(tickers)
-    step = 10
-    i = 0
-    df = pd.DataFrame()
-    while i < n_tick:
-        end = min(i + step, n_tick)
-        df_new = get_earnings_history(tickers[i:end], clear_cache, verbose=verbose)
-        if len(df_new) != 0:
-            #df = df.append(df_new)
-            df = pd.concat([df,df_new])
-        i = i + step
+    df = get_eps_features(tickers, clear_cache, n_workers=n_workers, verbose=verbose,
+                          columns=["ticker", "startdatetime", "epssurprisepct", "companyshortname", "beat"])
 
     df_best = _show_beat_ratio(df, last=last, threshold=threshold, min_qtrs=min_qtrs)
     display(df_best)
     return df
 
+def iter_beat_ratio(tickers, k=10, last=20, threshold=80, min_qtrs=4, stop=False,
+                    clear_cache=1, n_workers=8, verbose=False):
+    """Yield the top `k` tickers of EPS beat ratio >= `threshold` found so far each time they change.
+
+    EPS histories are downloaded concurrently (`n_workers`) and the best `k` tickers are
+    kept in a heap as the data arrive (cache data are read first in a single scan).
+
+    Args:
+        stop(bool): stop downloading after `k` tickers satisfying `threshold` and `min_qtrs`
+            are found (they are not always the best `k` tickers)
+        See `_show_beat_ratio()` for the others.
+    Yields:
+        dataframe of the current top `k` tickers (see `_show_beat_ratio()`)
+    """
+    if isinstance(tickers, str):
+        tickers = [tickers]
+    tickers = sorted(ticker.upper() for ticker in tickers)
+    columns = ["ticker", "startdatetime", "epssurprisepct", "companyshortname"]
+
+    rank = {ticker: -i for i, ticker in enumerate(tickers)} # ties are broken by ticker name
+    heap = [] # (beat ratio, count, rank, row) of the top k tickers, the worst first
+    found = 0
+    for df in _iter_frames(_get_earnings_history, tickers, cache_type="earnings", columns=columns,
+                           n_workers=n_workers, ordered=False, clear_cache=clear_cache, verbose=verbose):
+        counts = beat_counts(df, last=last)
+        counts = counts[(counts["beat ratio"] >= threshold) & (counts["count"] >= min_qtrs)]
+        changed = False
+        for row in counts.itertuples(name=None):
+            (ticker, name), ratio, beat, count = row
+            found += 1
+            entry = (ratio, count, rank[ticker], row)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+                changed = True
+            elif entry[:3] > heap[0][:3]:
+                heapq.heapreplace(heap, entry)
+                changed = True
+        if changed:
+            rows = [entry[3] for entry in sorted(heap, key=lambda entry: entry[:3], reverse=True)]
+            index = pd.MultiIndex.from_tuples([row[0] for row in rows], names=["ticker", "companyshortname"])
+            yield pd.DataFrame([row[1:] for row in rows], index=index, columns=["beat ratio", "beat", "count"])
+        if stop and found >= k:
+            verbose and print("found {} tickers".format(found))
+            return
+
+def search_beat_ratio(tickers, k=10, last=20, threshold=80, min_qtrs=4, stop=False,
+                      clear_cache=1, n_workers=8, verbose=False):
+    """Return the top `k` tickers of EPS beat ratio showing partial results while downloading.
+    See `iter_beat_ratio()` for the arguments.
+
+    Usage:
+        search_beat_ratio(si.tickers_nasdaq(), k=20, threshold=90, min_qtrs=12)
+    """
+    result = pd.DataFrame(columns=["beat ratio", "beat", "count"])
+    handle = None # updated in place in notebooks, printed again out of notebooks
+    for result in iter_beat_ratio(tickers, k=k, last=last, threshold=threshold, min_qtrs=min_qtrs, stop=stop,
+                                  clear_cache=clear_cache, n_workers=n_workers, verbose=verbose):
+        if handle is None:
+            handle = display(result, display_id=True)
+        else:
+            handle.update(result)
+    if len(result) == 0:
+        display(result)
+    return result
+
+def _scan_earnings(ticker, errors, **kwargs):
+    """_get_earnings_history() recording an exception in `errors` instead of raising it"""
+    try:
+        return _get_earnings_history(ticker, **kwargs)
+    except Exception as e:
+        errors[ticker] = e
+        return None
+
+def search_good_eps(tickers, last=20, threshold=80, min_qtrs=4, clear_cache=7, n_workers=4, rate=2.0,
+                    journal=None, restart=False, chunk=100, verbose=False):
+    """Search tickers of high EPS beat ratio in a resumable scan of a whole exchange.
+
+    Results of each ticker are written in a progress journal (scan_progress table of
+    cache/cache.sqlite) as the scan goes, so that an interrupted scan resumes from the
+    tickers not scanned yet. The journal is also used by later searches with other
+    `threshold` and `min_qtrs`.
+
+    Args:
+        tickers(list or str): ticker names or an exchange in `exchanges` (e.g. "nasdaq")
+        last, threshold, min_qtrs: see `_show_beat_ratio()`
+        clear_cache(int): number of days results in the journal and cache data are valid
+        n_workers(int): number of tickers downloaded concurrently
+        rate(float): maximum requests per second of the scan to the data source (None: no limit).
+            Other requests (e.g. of other threads) are not limited by it.
+        journal(str): name of the journal. Default is made from the tickers and `last`.
+        restart(bool): discard the journal and scan all tickers again
+        chunk(int): number of tickers written in the journal at a time
+    Returns:
+        dataframe of tickers satisfying `threshold` and `min_qtrs` (see `_show_beat_ratio()`)
+
+    Usage:
+        search_good_eps("nasdaq", last=40, threshold=95, min_qtrs=20)
+    """
+    source = data_source if not rate else ThrottledSource(data_source, rate)
+    if isinstance(tickers, str):
+        if tickers.lower() in exchanges:
+            verbose and print("getting tickers of {}".format(tickers))
+            tickers = source.exchange_tickers(tickers.lower())
+        else:
+            tickers = [tickers]
+    tickers = sorted({ticker.upper() for ticker in tickers if isinstance(ticker, str) and ticker != ""})
+    if journal is None:
+        key = json.dumps([tickers, last]).encode()
+        journal = "eps-{}".format(hashlib.sha1(key).hexdigest()[:12])
+
+    con = _db()
+    if restart:
+        con.execute("DELETE FROM scan_progress WHERE scan = ?", (journal,))
+    expire = 0 if clear_cache is False else time.time() - clear_cache * 86400
+    rows = con.execute("SELECT ticker FROM scan_progress WHERE scan = ? AND status != 'error' AND checked >= ?",
+                       (journal, expire)).fetchall()
+    done = {row[0] for row in rows}
+    todo = [ticker for ticker in tickers if ticker not in done]
+    print("journal {}: {} of {} tickers to scan".format(journal, len(todo), len(tickers)))
+
+    columns = ["ticker", "startdatetime", "epssurprisepct", "companyshortname"]
+    start = time.time()
+    for i in range(0, len(todo), chunk):
+        tickers_chunk = todo[i:i + chunk]
+        results = {ticker: ("nodata", None, None, None, None) for ticker in tickers_chunk}
+        errors = {}
+        for df in _iter_frames(_scan_earnings, tickers_chunk, cache_type="earnings", columns=columns,
+                               n_workers=n_workers, ordered=False, errors=errors, source=source,
+                               clear_cache=clear_cache, verbose=verbose):
+            for (ticker, name), ratio, beat, count in beat_counts(df, last=last).itertuples(name=None):
+                results[ticker] = ("done", name, float(ratio), int(beat), int(count))
+        for ticker, e in errors.items(): # scanned again when the scan is resumed
+            print("failed to get {}: {}".format(ticker, e))
+            results[ticker] = ("error", None, None, None, None)
+        now = time.time()
+        with con: # one transaction per chunk
+            con.executemany("INSERT OR REPLACE INTO scan_progress VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(journal, ticker, *result, now) for ticker, result in results.items()])
+        n_done = i + len(tickers_chunk)
+        eta = (time.time() - start) / n_done * (len(todo) - n_done)
+        print("{}/{} tickers scanned (ETA {:.0f} s)".format(n_done, len(todo), eta))
+
+    df = pd.read_sql_query("SELECT ticker, name AS companyshortname, ratio AS 'beat ratio', beat, count "
+                           "FROM scan_progress WHERE scan = ? AND status = 'done' AND ratio >= ? AND count >= ?",
+                           con, params=(journal, threshold, min_qtrs))
+    df = df[df["ticker"].isin(tickers)].set_index(["ticker", "companyshortname"])
+    df = df.sort_values(by=["beat ratio", "count"], ascending=False, kind="stable")
+    print("Tickers list of which beat ratio >= {}% within last {} quarters ({})".format(threshold, last, today()))
+    print("(data with more than {} quarter EPSs)".format(min_qtrs))
+    display(df)
+    return df
+
+# tables of screen(): last -> (downloaded times of cache data {(type, ticker): time}, table)
+_screen_tables = {}
+_screen_lock = threading.Lock()
+
+def _screen_rows(tickers, last=20):
+    """Return screening table of `tickers` made from cache data"""
+    df = read_cache("valuation", tickers=tickers)
+    if len(df) == 0:
+        return pd.DataFrame()
+    df = df.set_index("ticker")
+    df = df[[col for col in df.columns if df[col].dtype == "float64"]]
+    df["OCFM"] = df["OCF"] / df["REVENUE"]
+
+    eps = read_cache("earnings", tickers=list(df.index),
+                     columns=["ticker", "startdatetime", "epssurprisepct", "companyshortname"])
+    if len(eps) != 0:
+        counts = beat_counts(eps, last=last).droplevel("companyshortname")
+        df["BEAT_RATIO"] = counts["beat ratio"]
+        df["BEAT"] = counts["beat"]
+        df["COUNT"] = counts["count"]
+    else:
+        df["BEAT_RATIO"], df["BEAT"], df["COUNT"] = float("nan"), 0, 0
+    df[["BEAT", "COUNT"]] = df[["BEAT", "COUNT"]].fillna(0)
+    return df
+
+def screen_table(last=20):
+    """Return the table screened by `screen()`: typed valuation columns, OCFM and EPS beat ratio
+    of all tickers in cache. The table is kept in memory and in `cache_dir`/screen<last>.pkl,
+    and only tickers of which cache data were updated are read again.
+    """
+    rows = _db().execute("SELECT type, ticker, fetched FROM entries WHERE type IN ('valuation', 'earnings') "
+                         "AND (nrows IS NULL OR nrows > 0)").fetchall()
+    stamps = {(type, ticker): fetched for type, ticker, fetched in rows}
+    with _screen_lock:
+        if last not in _screen_tables:
+            try:
+                obj, version = _load_pickle("screen{}".format(last))
+                if version == cache_version:
+                    _screen_tables[last] = obj
+            except Exception: # no or broken file: build the table again
+                pass
+        old_stamps, table = _screen_tables.get(last, ({}, None))
+        changed = {ticker for key, fetched in stamps.items() if old_stamps.get(key) != fetched for ticker in key[1:]}
+        changed |= {ticker for key in old_stamps if key not in stamps for ticker in key[1:]}
+        if table is not None and len(changed) == 0:
+            return table
+
+        tickers = sorted({ticker for type, ticker in stamps if type == "valuation"} & changed)
+        frames = [] if table is None else [table.drop(index=list(changed), errors="ignore")]
+        frames.append(_screen_rows(tickers, last=last))
+        table = pd.concat([df for df in frames if len(df) != 0]) if any(len(df) for df in frames) else pd.DataFrame()
+        _screen_tables[last] = (stamps, table)
+        os.makedirs(cache_dir, exist_ok=True)
+        save_pickle("screen{}".format(last), _screen_tables[last])
+        return table
+
+@profiled("screen")
+def screen(query, tickers=None, last=20, sort="PSR", ascending=True):
+    """Screen tickers with valuation and EPS history data in cache (nothing is downloaded).
+
+    Args:
+        query(str): condition in `DataFrame.query()` syntax over the columns below, e.g.
+            "PSR < 10 and BEAT_RATIO >= 95 and COUNT >= 20 and OCFM > 0.15"
+            - keys of `valuation_schema` (e.g. PSR, PBR, PER, CAP, ROE, QRG, OCF)
+            - OCFM: operating cash flow margin (OCF/REVENUE)
+            - BEAT_RATIO (%), BEAT, COUNT: EPS beat ratio, number of beats and number of
+              quarters within `last` quarters
+        tickers(list): tickers to be screened. All tickers in cache if None.
+        sort(str): column to rank the result
+    Returns:
+        dataframe of the tickers satisfying `query` sorted by `sort`
+
+    Usage:
+        get_valuation(tickers); get_earnings_history(tickers) # fill the cache
+        screen("PSR < 10 and BEAT_RATIO >= 95 and COUNT >= 20 and OCFM > 0.15")
+    """
+    df = screen_table(last=last)
+    if len(df) == 0:
+        return df
+    if tickers is not None:
+        df = df[df.index.isin([ticker.upper() for ticker in tickers])]
+    return df.query(query).sort_values(by=sort, ascending=ascending)
+
 ## financial data
 def _get_financial_history(ticker, clear_cache=1, yearly=True, verbose=False):
     """return None if no data is available"""
@@ -708,40 +2802,43 @@ def _get_financial_history(ticker, clear_cache=1, yearly=True, verbose=False):
     type="financial"
     term="_y" if yearly else "_q"
     dfname = ticker + "_" + type + term
-    df=get_cache(fname=dfname, clear_cache=clear_cache, verbose=verbose)
-    if df is not None: # True if data file exists (df is empty if no data is available)
-        return(df)
-    
-    if not check_ticker(ticker):
+    return _get_or_fetch(dfname, lambda: _fetch_financial_history(ticker, dfname, yearly=yearly, verbose=verbose),
+                         clear_cache=clear_cache, verbose=verbose)
+
+def _fetch_financial_history(ticker, dfname, yearly=True, verbose=False):
+    """Download financial data of `ticker` and save it as cache data `dfname`"""
+    type="financial"
+    if not is_valid_ticker(ticker, verbose=verbose):
         print("invalid ticker name {}".format(ticker))
         return None
     
     verbose and print("getting new {} data".format(type))
-    df_cf = si.get_cash_flow(ticker,yearly=yearly)
-    df_bs = si.get_balance_sheet(ticker,yearly=yearly)
-    df_is = si.get_income_statement(ticker,yearly=yearly)
+    df_cf = data_source.cash_flow(ticker,yearly=yearly)
+    df_bs = data_source.balance_sheet(ticker,yearly=yearly)
+    df_is = data_source.income_statement(ticker,yearly=yearly)
 
     if len(df_cf) == 0 or len (df_bs) == 0 or len(df_is)==0:
         print("no data for {}".format(ticker))
-        save_pickle(dfname=dfname, obj=None)
+        save_cache(dfname=dfname, obj=None)
         return None
 
     df = pd.concat([df_cf,df_bs,df_is.drop("netIncome")])
 
     if len(df) == 0:
         print("no data for {}".format(ticker))
-        save_pickle(dfname=dfname, obj=None)
+        save_cache(dfname=dfname, obj=None)
         return None
 
     df=df.T.astype("float").reset_index()#.sort_index()
     df.index.name = None
     df["ticker"] = ticker
-    save_pickle(dfname=dfname, obj=df)
+    save_cache(dfname=dfname, obj=df)
 
     return df
 
-def get_financial_history(tickers, clear_cache=1, yearly=True, verbose=False):
+def get_financial_history(tickers, clear_cache=1, yearly=True, n_workers=None, verbose=False):
     """Get financial history data.
+    `n_workers` tickers are downloaded concurrently.
     
     Following data will be downloaded.
     - return values by si.get_cash_flow()
@@ -787,7 +2884,9 @@ def get_financial_history(tickers, clear_cache=1, yearly=True, verbose=False):
         "incomeBeforeTax": "Income Before Tax",
     }
 
-    df = get_data(fn=_get_financial_history,tickers=tickers,clear_cache=clear_cache,verbose=verbose,yearly=yearly)
+    term="_y" if yearly else "_q"
+    df = get_data(fn=_get_financial_history,tickers=tickers,cache_type="financial"+term,n_workers=n_workers,
+                  clear_cache=clear_cache,verbose=verbose,yearly=yearly)
     target= [
             "endDate",
             "ticker",
@@ -806,6 +2905,7 @@ def get_financial_history(tickers, clear_cache=1, yearly=True, verbose=False):
 
     return df
 
+@profiled("plot_financial_history")
 def plot_financial_history(tickers, clear_cache=1, verbose=False):
     data={}
     data["years"]=get_financial_history(tickers, clear_cache=clear_cache, yearly=True, verbose=verbose)